@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""Benchmark the diff and rendering pipeline on synthetic outputs.
+
+Each case is run through every stage for each diff engine: computing the
+line diff, converting it to rows with dmp_to_mdiff, applying
+limit_revealed_lines_to, and rendering the results page, as seen by an
+admin, with HTMLDiff.make_whole_file. The best time over the repetitions and
+the peak memory growth of each stage are reported.
+
+Results saved with --save can be compared against a later run, for example
+of another commit, with --compare.
+
+"""
+from submit.diff_render import MAX_NUM_REVEALS, HTMLDiff, \
+    limit_revealed_lines_to
+from submit.diff_unit import DIFF_ENGINES, CompactDiff, DiffWithMetadata, \
+    dmp_to_mdiff, line_diff
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+
+MAX_FILE_SIZE = 81920  # The largest output saved by a worker
+STAGES = ('diff', 'mdiff', 'limit', 'render')
+
+
+def make_cases(seed):
+    """Return a list of (name, expected output, given output) tuples."""
+    rand = random.Random(seed)
+
+    def numbered(count):
+        return ['{} {}\n'.format(i, rand.randint(0, 1 << 30))
+                for i in range(count)]
+
+    lines = numbered(2000)
+    expected = ''.join(lines)
+    one_line = list(lines)
+    one_line[len(lines) // 2] = 'changed\n'
+    shuffled = list(lines)
+    rand.shuffle(shuffled)
+    huge = numbered(MAX_FILE_SIZE // 16)
+    huge_given = [x if rand.random() > 0.01 else 'changed\n' for x in huge]
+    garbage = ''.join(chr(rand.randint(0, 255)) for _ in range(MAX_FILE_SIZE))
+    long_line = ''.join(chr(rand.randint(97, 122)) for _ in range(20000))
+    wide = ['{}\t<{}> & {}\n'.format(i, 'x ' * 60, rand.random())
+            for i in range(2000)]
+    wide_given = [x if i % 3 else x.replace('x', 'y', 5)
+                  for i, x in enumerate(wide)]
+    return [('identical', expected, expected),
+            ('one line', expected, ''.join(one_line)),
+            ('reordered', expected, ''.join(shuffled)),
+            ('huge', ''.join(huge), ''.join(huge_given)[:MAX_FILE_SIZE]),
+            ('binary garbage', expected, garbage),
+            ('long lines', long_line + '\n', long_line[::-1] + '\n'),
+            ('wide lines', ''.join(wide), ''.join(wide_given))]
+
+
+def peak_memory():
+    """Return the peak resident memory (in KiB) since the last reset."""
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def reset_peak_memory():
+    """Reset the peak memory to the current memory, where supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return peak_memory()
+    except IOError:
+        return None
+
+
+def measure(func, repeat):
+    """Return (result, best time, peak memory growth in KiB) of func()."""
+    best = None
+    memory = None
+    for _ in range(repeat):
+        gc.collect()
+        before = reset_peak_memory()
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if before is not None:
+            memory = max(memory, peak_memory() - before, 0)
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best, memory
+
+
+def run_case(expected, given, engine, repeat):
+    """Return a dictionary mapping each stage to its (time, memory)."""
+    def render():
+        diff = CompactDiff(expected, given, None, engine)
+        diff._diff  # Build the rows outside of the measurement
+        diff.hide_expected = False
+        if diff.outputs_match():  # As stored for matching outputs
+            diff = None
+        renderable = DiffWithMetadata(diff=diff, number=1, group='group',
+                                      name='case', points=1,
+                                      status='success', extra=None)
+
+        def make_page():
+            renderer = HTMLDiff(points_possible=1, num_reveal_limit=None)
+            renderer.add_renderable(renderable)
+            return renderer.make_whole_file()
+        return make_page
+
+    results = {}
+    chunks, seconds, memory = measure(
+        lambda: line_diff(expected, given, engine), repeat)
+    results['diff'] = seconds, memory
+    rows, seconds, memory = measure(lambda: list(dmp_to_mdiff(chunks)),
+                                    repeat)
+    results['mdiff'] = seconds, memory
+    results['limit'] = measure(lambda: list(limit_revealed_lines_to(
+        rows, MAX_NUM_REVEALS, False)), repeat)[1:]
+    results['render'] = measure(render(), repeat)[1:]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--compare', metavar='FILE',
+                        help='show times relative to previously saved results')
+    parser.add_argument('--engine', action='append', choices=DIFF_ENGINES,
+                        help='diff engine to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to run each stage (default: 3)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as JSON')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed used to generate the cases (default: 0)')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+
+    results = {}
+    width = 32 if baseline else 24
+    print('{:<16}{:<6}'.format('case', 'engine') +
+          ''.join('{:>{}}'.format(x, width) for x in STAGES))
+    for name, expected, given in make_cases(args.seed):
+        for engine in sorted(args.engine or DIFF_ENGINES):
+            key = '{}/{}'.format(name, engine)
+            results[key] = run_case(expected, given, engine, args.repeat)
+            row = '{:<16}{:<6}'.format(name, engine)
+            for stage in STAGES:
+                seconds, memory = results[key][stage]
+                cell = '{:.4f}s'.format(seconds)
+                if memory is not None:
+                    cell += ' {:>6}K'.format(memory)
+                if key in baseline and baseline[key][stage][0]:
+                    cell += ' {:>5.2f}x'.format(
+                        seconds / baseline[key][stage][0])
+                row += '{:>{}}'.format(cell, width)
+            print(row)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
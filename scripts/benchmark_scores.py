@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""Benchmark computing the best submissions of a project's groups.
+
+A database, in memory unless --url is given, is seeded with a class whose
+project has a group per student, and one for an admin, each with several
+submissions around the deadline and a result for every testable.
+Project.process_submissions is then timed, and its queries counted, against
+the equivalent computed one submission at a time through the relationships.
+
+"""
+from datetime import datetime, timedelta
+from pyramid_addons.helpers import UTC
+from sqlalchemy import create_engine, event
+from submit.models import (Class, Group, Project, Session, Submission,
+                           Testable, TestableResult, User, UserToGroup,
+                           configure_sql, create_schema)
+import argparse
+import random
+import sys
+import time
+import transaction
+
+
+def seed(groups, submissions, testables, seed):
+    """Create the project and return its id."""
+    rand = random.Random(seed)
+    deadline = datetime(2014, 3, 14, tzinfo=UTC())
+    class_ = Class(name='CS 101')
+    project = Project(name='Project 1', class_=class_, deadline=deadline)
+    tbs = [Testable(name='Testable {}'.format(i), executable='a.out',
+                    project=project) for i in range(testables)]
+    admin = User(name='Admin', username='admin', password='password')
+    class_.admins.append(admin)
+    Session.add(class_)
+    for i in range(groups + 1):
+        user = admin if i == groups else User(
+            name='Student {}'.format(i), username='student{}'.format(i),
+            password='password')
+        class_.users.append(user)
+        group = Group(project=project)
+        Session.add(UserToGroup(group=group, project=project, user=user))
+        for _ in range(submissions):
+            created = deadline + timedelta(hours=rand.randint(-240, 48))
+            submission = Submission(created_at=created, created_by=user,
+                                    group=group, project=project)
+            for testable in tbs:
+                Session.add(TestableResult(
+                    points=rand.randint(0, 10), status='success',
+                    submission=submission, testable=testable))
+            submission.update_scores()
+    Session.flush()
+    project_id = project.id
+    transaction.commit()
+    return project_id
+
+
+def reference_process_submissions(project):
+    """Return (best_ontime, best) summing each submission's points."""
+    best_ontime = {}
+    best = {}
+    admins = set(project.class_.admins)
+    for sub in sorted(project.submissions, key=lambda x: x.created_at):
+        if set(sub.group.users) & admins:
+            continue
+        points = sum(x.points for x in sub.testable_results)
+        if sub.group not in best or points > best[sub.group][1]:
+            best[sub.group] = sub, points
+        if not sub.is_late and (sub.group not in best_ontime or
+                                points > best_ontime[sub.group][1]):
+            best_ontime[sub.group] = sub, points
+    return best_ontime, best
+
+
+def measure(func, project_id, repeat, queries):
+    """Return (result ids, best time, queries) of func(project).
+
+    Each repetition starts from an empty session.
+
+    """
+    best = None
+    for _ in range(repeat):
+        Session.remove()
+        project = Project.fetch_by(id=project_id)
+        del queries[:]
+        start = time.time()
+        result = func(project)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    ids = [{group.id: (sub.id, points)
+            for group, (sub, points) in x.items()} for x in result]
+    return ids, best, len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, default=300,
+                        help='number of student groups (default: 300)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to run each version (default: 3)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed used to generate the data (default: 0)')
+    parser.add_argument('--submissions', type=int, default=15,
+                        help='submissions per group (default: 15)')
+    parser.add_argument('--testables', type=int, default=8,
+                        help='testables of the project (default: 8)')
+    parser.add_argument('--url', default='sqlite://',
+                        help='empty database to seed (default: in memory)')
+    args = parser.parse_args()
+
+    engine = create_engine(args.url)
+    configure_sql(engine)
+    create_schema()
+    queries = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda *args: queries.append(args[2]))
+    project_id = seed(args.groups, args.submissions, args.testables,
+                      args.seed)
+
+    reference, reference_time, reference_queries = measure(
+        reference_process_submissions, project_id, args.repeat, queries)
+    result, result_time, result_queries = measure(
+        lambda x: x.process_submissions()[1:], project_id, args.repeat,
+        queries)
+    print('{:<24}{:>10}{:>10}'.format('version', 'seconds', 'queries'))
+    print('{:<24}{:>10.4f}{:>10}'.format('per submission', reference_time,
+                                         reference_queries))
+    print('{:<24}{:>10.4f}{:>10}'.format('process_submissions',
+                                         result_time, result_queries))
+    if result != reference:
+        print('The best submissions differ')
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Convert pickled diff files to the compact diff format.
+
+Each converted diff references its expected output, which is stored as a
+File. Every TestCaseResult pointing at a pickled diff is pointed at the
+compact diff instead. The pickled files are left in place.
+
+"""
+from submit.diff_unit import DIFF_HEADER, CompactDiff
+from submit.models import File, Session, TestCase, TestCaseResult
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+import os
+import pickle
+import sys
+import transaction
+
+# Hack for old pickle files
+import submit
+sys.modules['nudibranch'] = submit
+sys.modules['nudibranch.diff_unit'] = submit.diff_unit
+sys.modules['nudibranch.models'] = submit.models
+
+BATCH_SIZE = 256
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: {} <config_uri>\n'
+          '(example: "{} development.ini")'.format(cmd, cmd))
+    sys.exit(1)
+
+
+def convert_diff(file_, base_path):
+    """Return the compact File for the pickled diff File, or None."""
+    with open(File.file_path(base_path, file_.sha1)) as fp:
+        data = fp.read()
+    if data.startswith(DIFF_HEADER + '\n'):
+        return None  # Already converted
+    diff = pickle.loads(data)
+    if diff.outputs_match():
+        return None
+    compact, expected = CompactDiff.from_legacy(diff)
+    expected_file = File.fetch_or_create(expected, base_path)
+    return File.fetch_or_create(compact.dumps(expected_file.sha1), base_path)
+
+
+def main():
+    if len(sys.argv) < 2:
+        usage(sys.argv)
+    config_uri = sys.argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    Session.configure(bind=engine)
+    base_path = settings['file_directory']
+
+    file_ids = [x[0] for x in Session.query(TestCaseResult.diff_id).join(
+        TestCase).filter(TestCase.output_type == 'diff',
+                         TestCaseResult.diff_id.isnot(None)).distinct()]
+    converted = failed = old_size = new_size = 0
+    for i in range(0, len(file_ids), BATCH_SIZE):
+        for file_ in File.query_by().filter(
+                File.id.in_(file_ids[i:i + BATCH_SIZE])):
+            try:
+                new_file = convert_diff(file_, base_path)
+            except Exception as exc:  # Leave the pickled diff in place
+                print('Could not convert {}: {!r}'.format(file_.sha1, exc))
+                failed += 1
+                continue
+            if not new_file:
+                continue
+            Session.query(TestCaseResult).filter_by(diff_id=file_.id).update(
+                {'diff_id': new_file.id}, synchronize_session=False)
+            converted += 1
+            old_size += file_.size
+            new_size += new_file.size
+        transaction.commit()
+        print('{}/{} diffs processed'.format(
+            min(i + BATCH_SIZE, len(file_ids)), len(file_ids)))
+    print('Converted {} diffs ({} bytes to {} bytes), {} failed'
+          .format(converted, old_size, new_size, failed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Queue the pending outputs of test case results for the diff worker.
+
+An output stays pending, and its result's diff is shown as being computed,
+until the diff worker stores its diff. Run this to recover outputs whose
+message was never queued or whose diff failed, of the given submissions
+(default: every submission).
+
+"""
+from submit.models import File, Session, TestCaseResult
+from submit.workers import publish
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+import os
+import sys
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: {} <config_uri> [submission_id ...]\n'
+          '(example: "{} development.ini")'.format(cmd, cmd))
+    sys.exit(1)
+
+
+def main():
+    if len(sys.argv) < 2:
+        usage(sys.argv)
+    config_uri = sys.argv[1]
+    try:
+        submission_ids = [int(x) for x in sys.argv[2:]]
+    except ValueError:
+        usage(sys.argv)
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    Session.configure(bind=engine)
+
+    query = (Session.query(TestCaseResult.submission_id,
+                           TestCaseResult.test_case_id, File.sha1)
+             .join(File, File.id == TestCaseResult.output_id))
+    if submission_ids:
+        query = query.filter(
+            TestCaseResult.submission_id.in_(submission_ids))
+    pending = {}
+    for submission_id, test_case_id, sha1 in query:
+        pending.setdefault(submission_id, []).append((test_case_id, sha1))
+    for i, (submission_id, outputs) in enumerate(sorted(pending.items()),
+                                                 start=1):
+        publish(settings['queue_server'], settings['queue_diff'],
+                submission_id=submission_id, outputs=outputs)
+        print('{}/{} submissions queued'.format(i, len(pending)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
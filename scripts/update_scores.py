@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Recompute the stored scores of submissions from their results.
+
+Run after the migration adding the scores to fill in the pending testables,
+or to repair the scores of the given projects (default: every project).
+
+"""
+from submit.models import Project, Session
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config
+import os
+import sys
+import transaction
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: {} <config_uri> [project_id ...]\n'
+          '(example: "{} development.ini")'.format(cmd, cmd))
+    sys.exit(1)
+
+
+def main():
+    if len(sys.argv) < 2:
+        usage(sys.argv)
+    config_uri = sys.argv[1]
+    try:
+        project_ids = [int(x) for x in sys.argv[2:]]
+    except ValueError:
+        usage(sys.argv)
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    Session.configure(bind=engine)
+
+    if not project_ids:
+        project_ids = [x[0] for x in Session.query(Project.id)]
+    for i, project_id in enumerate(project_ids, start=1):
+        project = Project.fetch_by(id=project_id)
+        if not project:
+            print('Invalid project id: {}'.format(project_id))
+            continue
+        project.update_scores()
+        transaction.commit()
+        print('{}/{} projects updated'.format(i, len(project_ids)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -46,6 +46,7 @@ setup(name=PACKAGE_NAME,
       [paste.app_factory]
       main = {package}:main
       [console_scripts]
+      worker_diff = {package}.workers.diff:main
       worker_verification = {package}.workers.verification:main
       worker_proxy = {package}.workers.proxy:main
       """.format(package=PACKAGE_NAME),
@@ -57,6 +58,7 @@ setup(name=PACKAGE_NAME,
       license='Simplified BSD License',
       long_description=README,
       packages=find_packages(),
+      test_suite=PACKAGE_NAME,
       url='https://github.com/ucsb-cs/submit',
       version=VERSION,
       zip_safe=False)
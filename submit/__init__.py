@@ -3,9 +3,13 @@ from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
 from pyramid.security import ALL_PERMISSIONS, Allow, Authenticated
 from pyramid.session import UnencryptedCookieSessionFactoryConfig
+from pyramid.tweens import INGRESS
 from sqlalchemy import engine_from_config
 from .helpers import get_queue_func
+from .diff_render import RENDERER_VERSION  # Must follow helpers (cyclic)
+from .instrumentation import RouteStats, count_queries
 from .models import configure_sql, create_schema, populate_database
+from .render_cache import RenderCache
 from .security import get_user, group_finder
 
 __version__ = '1.2.0'
@@ -48,9 +52,12 @@ def add_routes(config):
     config.add_route('project_item_detailed_user',
                      '/p/{project_id}/u/{username}')
     config.add_route('project_scores', '/p/{project_id}/scores')
+    config.add_route('query_stats', '/query_stats')
     config.add_route('session', '/session')
     config.add_route('submission', '/submission')
     config.add_route('submission_item', '/submission/{submission_id}')
+    config.add_route('submission_item_diff',
+                     '/submission/{submission_id}/diff/{test_case_id}')
     config.add_route('submission_item_gen', '/submission/{submission_id}/gen')
     config.add_route('test_case', '/test_case')
     config.add_route('test_case_item', '/test_case/{test_case_id}')
@@ -78,6 +85,7 @@ def main(global_config, **settings):
     # Initialize the database
     engine = engine_from_config(settings, 'sqlalchemy.')
     configure_sql(engine)
+    count_queries(engine)
 
     secure_cookies = settings.get('secure_cookies') != 'false'
     if 'pyramid_debugtoolbar' in settings['pyramid.includes']:
@@ -102,6 +110,18 @@ def main(global_config, **settings):
     config.add_request_method(get_user, 'user', reify=True)
     config.add_request_method(get_queue_func, 'queue', reify=True)
 
+    # Cache rendered diff tables next to the stored files
+    cache_directory = settings.get('diff_cache_directory') or \
+        settings['file_directory'].rstrip('/') + '_rendered'
+    config.registry.render_cache = RenderCache(
+        cache_directory, RENDERER_VERSION,
+        max_size=int(settings.get('diff_cache_size', 268435456)))
+
+    # Report the queries of each request, see instrumentation.py
+    config.registry.route_stats = RouteStats()
+    config.add_tween('submit.instrumentation.query_stats_tween_factory',
+                     under=INGRESS)
+
     add_routes(config)
     config.scan()
     return config.make_wsgi_app()
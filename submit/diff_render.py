@@ -1,4 +1,6 @@
 import difflib
+import re
+from .diff_unit import DiffSummary
 
 _file_template = """
 <div id="diff_table_div">
@@ -37,14 +39,30 @@ _legend = """
                   </table></td> </tr>
     </table>"""
 
+MARKUP_HTML = (('\0+', '<span class="diff_add">'),
+               ('\0-', '<span class="diff_sub">'),
+               ('\0^', '<span class="diff_chg">'), ('\1', '</span>'))
 MAX_NUM_REVEALS = 3
-MAX_DIFF_LINES = 512
+RENDERER_VERSION = 2  # Increment when the html of rendered tables changes
+MAX_DIFF_LINES = 512  # Differing lines shown of a diff, across all pages
+DIFF_PAGE_ROWS = 512
 LINE_WRAP = 64
 SOFT_MAX_LINE_LENGTH = 128
 HARD_MAX_LINE_LENGTH = 1024
 
 
-def limit_revealed_lines_to(diffs, limit, hide_expected):
+def limit_revealed_lines_to(diffs, limit, hide_expected, page=0,
+                            status=None):
+    """Yield the rows of the page of diffs.
+
+    The diff is cut, with a truncation row, after MAX_DIFF_LINES differing
+    lines or once more than `limit` differing lines would reveal the
+    expected output. Only when `status` is given is the diff paged, in
+    pages of DIFF_PAGE_ROWS rows, and `status['more']` set to whether rows
+    remain after this page. Rows of earlier pages are skipped without any
+    formatting though they still count towards both limits.
+
+    """
     def truncate_line(todata, expected_length):
         max_length = min(max(expected_length, SOFT_MAX_LINE_LENGTH),
                          HARD_MAX_LINE_LENGTH)
@@ -60,17 +78,29 @@ def limit_revealed_lines_to(diffs, limit, hide_expected):
 
     num_reveals = 0
     different_lines = 0
-
-    obscured = '<<Expected output obscured by instructor.>>'
-    for fromdata, todata, flag in diffs:
+    if status is None:
+        start, stop = 0, None
+    else:
+        start = page * DIFF_PAGE_ROWS
+        stop = start + DIFF_PAGE_ROWS
+    trun = '...', '<<Remaining diff not shown>>'
+
+    obscured = '<<Expected output obscured by instructor.>>' if page == 0 \
+        else ''
+    for row, (fromdata, todata, flag) in enumerate(diffs):
         if flag:
             different_lines += 1
             if '\0-' in fromdata[1] or '\0^' in fromdata[1]:
                 num_reveals += 1
         if different_lines > MAX_DIFF_LINES or limit and num_reveals > limit:
-            trun = '...', '<<Remaining diff not shown>>'
-            yield trun, trun, False
+            if row >= start:
+                yield trun, trun, False
             break
+        if stop is not None and row >= stop:
+            status['more'] = True
+            break
+        if row < start:
+            continue
         todata = truncate_line(todata, len(fromdata[1]))
         if hide_expected:
             fromdata = fromdata[0], obscured
@@ -119,23 +149,56 @@ class HTMLDiff(difflib.HtmlDiff):
     SHOW_HIDE_ROWS = \
         '<a href="javascript:void(0)" onclick="showHideRows(this);">h</a>'
     NO_DIFFERENCES = '<td></td><td>&nbsp;No Differences Found&nbsp;</td>'
+    SHOW_DIFF = ('<table class="diff"><tbody><tr><td class="diff_next"></td>'
+                 '<td><a href="{0}" onclick="loadDiffPage(this); '
+                 'return false;">Show diff</a> ({1} differing lines from '
+                 'line {2})</td></tr></tbody></table>')
+    MORE_ROWS = ('        <tbody><tr><td class="diff_next"></td>'
+                 '<td colspan="5"><a href="{0}" onclick="loadDiffPage(this); '
+                 'return false;">Show more lines</a></td></tr></tbody>\n')
     EMPTY_FILE = '<td></td><td>&nbsp;Empty File&nbsp;</td>'
     MAX_SAME_LINES_BEFORE_SHOW_HIDE = 5  # must be >= 4
 
-    def __init__(self, points_possible=0, num_reveal_limit=MAX_NUM_REVEALS):
+    def __init__(self, points_possible=0, num_reveal_limit=MAX_NUM_REVEALS,
+                 page_url=None, prefix=None):
+        """Create the renderer.
+
+        `page_url` is called with a renderable and a page number and returns
+        the url that renders that page of the renderable's diff. Without it
+        diffs are truncated after their first page. `prefix` fixes the
+        anchor prefix of tables rendered on their own.
+
+        """
         super(HTMLDiff, self).__init__(wrapcolumn=LINE_WRAP)
         self._legend = _legend
         self._table_template = _table_template
         self._file_template = _file_template
         self._last_collapsed = False
         self._mapping = {}  # maps a renderable to html
+        # splits text into change markers and runs of plain text that are
+        # at most the wrap column in length
+        self._markup_re = re.compile(
+            '\0.?|\1|[^\0\1]{{1,{0}}}'.format(self._wrapcolumn), re.S)
         self._num_reveal_limit = num_reveal_limit
+        self._page_status = None
+        self._page_url = page_url
         self._points_possible = points_possible
+        self._prefix_id = prefix
         self._show_legend = False
 
     def add_renderable(self, renderable):
         value = renderable.custom_output
-        if renderable.show_diff_table():
+        if renderable.show_diff_table() and self._page_url and \
+                isinstance(renderable.diff, DiffSummary):
+            # Only the summary is loaded so link to the diff itself
+            lines = renderable.diff.lines
+            if renderable.diff.partial:
+                lines = 'more than {}'.format(lines)
+            value += self.SHOW_DIFF.format(
+                self._page_url(renderable, 0), lines,
+                renderable.diff.first_line)
+            self._show_legend = True
+        elif renderable.show_diff_table():
             self._show_legend = True
             self._last_collapsed = False
             table = self.make_table(renderable)
@@ -152,15 +215,19 @@ class HTMLDiff(difflib.HtmlDiff):
             self.FAILING_BLOCK.format(renderable.id, renderable.group, name,
                                       value)
 
-    def make_table(self, renderable):
+    def make_table(self, renderable, page=0):
         """Makes unique anchor prefixes so that multiple tables may exist
-        on the same page without conflict."""
+        on the same page without conflict.
+
+        Only the rows of the given page of the diff are rendered.
+
+        """
         self._make_prefix()
-        diffs = renderable.diff._diff
+        diffs = renderable.diff.iter_diff()
+        self._page_status = {} if self._page_url else None
 
         # set up iterator to wrap lines that exceed desired width
-        if self._wrapcolumn:
-            diffs = self._line_wrapper(diffs, renderable.diff.hide_expected)
+        diffs = self._line_wrapper(diffs, renderable.diff.hide_expected, page)
 
         # collect up from/to lines and flags into lists (also format the lines)
         fromlist, tolist, flaglist = self._collect_lines(diffs)
@@ -181,6 +248,9 @@ class HTMLDiff(difflib.HtmlDiff):
             else:
                 s.append(fmt % (next_id[i], next_href[i], fromlist[i],
                                 next_href[i], tolist[i]))
+        if self._page_status and self._page_status.get('more'):
+            s.append(self.MORE_ROWS.format(
+                self._page_url(renderable, page + 1)))
         header_row = '<thead><tr>%s%s%s%s</tr></thead>' % (
             '<th class="diff_next"><br /></th>',
             '<th colspan="2" class="diff_header">%s</th>' % self.FROM_DESC,
@@ -192,11 +262,7 @@ class HTMLDiff(difflib.HtmlDiff):
             header_row=header_row,
             prefix=self._prefix[1])
 
-        return table.replace('\0+', '<span class="diff_add">'). \
-            replace('\0-', '<span class="diff_sub">'). \
-            replace('\0^', '<span class="diff_chg">'). \
-            replace('\1', '</span>'). \
-            replace('\t', '&nbsp;')
+        return table
 
     def _format_line(self, side, flag, linenum, text):
         """Returns HTML markup of "from" / "to" text lines
@@ -205,6 +271,9 @@ class HTMLDiff(difflib.HtmlDiff):
         flag -- indicates if difference on line
         linenum -- line number (used for line number column)
         text -- line text to be marked up
+
+        The text is escaped and its change markers are converted to spans
+        here so that the table needs no further passes.
         """
         try:
             linenum = '%d' % linenum
@@ -212,23 +281,61 @@ class HTMLDiff(difflib.HtmlDiff):
         except TypeError:
             # handle blank lines where linenum is '>' or ''
             id = ''
-        # replace those things that would get confused with HTML symbols
-        text = text.replace("&", "&amp;"). \
-            replace(">", "&gt;"). \
-            replace("<", "&lt;")
+        # spaces become non-breaking thus only other whitespace is stripped
+        text = text.rstrip('\t\n\r\x0b\x0c')
 
+        # replace those things that would get confused with HTML symbols and
         # make space non-breakable so they don't get compressed or line wrapped
-        text = text.replace(' ', '&nbsp;').rstrip()
+        text = text.replace('&', '&amp;').replace('>', '&gt;'). \
+            replace('<', '&lt;').replace(' ', '&nbsp;').replace('\t', '&nbsp;')
 
         color = ''
-        if '\0^' in text or '\0+' in text or '\0-' in text:
-            color = ';background-color:{0}'
-            if side == 0:
-                color = color.format('#ffe6e6')
-            else:
-                color = color.format('#e3ffe3')
+        if '\0' in text:
+            if '\0^' in text or '\0+' in text or '\0-' in text:
+                color = ';background-color:{0}'.format(
+                    '#ffe6e6' if side == 0 else '#e3ffe3')
+            for marker, html in MARKUP_HTML:
+                text = text.replace(marker, html)
+        else:
+            text = text.replace('\1', '</span>')
         return self.TD_DIFF_HEADER.format(id, linenum, color, text)
 
+    def _split_line(self, data_list, line_num, text):
+        """Wrap text at the wrap column as difflib does.
+
+        Runs of plain text are stepped over as a whole rather than a
+        character at a time, and rather than recursing on the remaining
+        text its position and the marker it continues are tracked.
+
+        """
+        width = self._wrapcolumn
+        prefix = ''  # reopens the marker of the previous piece
+        start = 0
+        while line_num and len(prefix) + len(text) - start - 3 * (
+                bool(prefix) + text.count('\0', start)) > width:
+            count = 0
+            mark = prefix[1:]
+            split = start
+            for match in self._markup_re.finditer(text, start):
+                token = match.group()
+                if token[0] == '\0':
+                    mark = token[1:]
+                elif token == '\1':
+                    mark = ''
+                elif count + len(token) >= width:
+                    split = match.start() + width - count
+                    break
+                else:
+                    count += len(token)
+                split = match.end()
+            # each piece is wrapped by its own markers
+            data_list.append((line_num, prefix + text[start:split] +
+                              ('\1' if mark else '')))
+            prefix = '\0' + mark if mark else ''
+            start = split
+            line_num = '>'
+        data_list.append((line_num, prefix + text[start:]))
+
     def _make_test_summary(self):
         """Return html tables for failed and passed tests."""
         template = ('<div class="pull-left well well-small">'
@@ -257,12 +364,18 @@ class HTMLDiff(difflib.HtmlDiff):
         return self._file_template % {'summary': self._make_test_summary(),
                                       'table': '\n'.join(tables)}
 
-    def _line_wrapper(self, diffs, hide_expected):
+    def _line_wrapper(self, diffs, hide_expected, page=0):
         diffs = limit_revealed_lines_to(diffs, self._num_reveal_limit,
-                                        hide_expected)
+                                        hide_expected, page,
+                                        self._page_status)
         return super(HTMLDiff, self)._line_wrapper(diffs)
 
     def _make_prefix(self):
+        if self._prefix_id is not None:
+            self._prefix = ['from{0}_'.format(self._prefix_id),
+                            'to{0}_'.format(self._prefix_id),
+                            'same{0}_'.format(self._prefix_id)]
+            return
         sameprefix = "same{0}_".format(HTMLDiff._default_prefix)
         super(HTMLDiff, self)._make_prefix()
         self._prefix.append(sameprefix)
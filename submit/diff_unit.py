@@ -1,7 +1,35 @@
+import json
+import operator
+import pickle
 import xml.sax.saxutils
 from diff_match_patch import diff_match_patch as DMP
+from itertools import izip_longest, takewhile
 from .helpers import alphanum_key
 
+# The first line of every diff file stored in the compact format
+DIFF_HEADER = 'submit-diff 1'
+
+DIFF_ISSUES = {
+    'extra_newline': 'Your program\'s output should not end with a newline.',
+    'extra_output': 'Your program should not have produced output.',
+    'missing_newline': 'Your program\'s output should end with a newline.',
+    'mismatch': 'Your program\'s output did not match the expected.',
+    'no_output': 'Your program should have produced output.',
+    'pending': 'The diff of your program\'s output is being computed.'}
+
+# Bound on the steps fast_line_diff takes to find a diff
+DIFF_MIN_WORK = 65536
+DIFF_WORK_PER_LINE = 16
+
+# Lines of each output first diffed by partial_line_diff to find a hunk, and
+# the hunks it finds that way before diffing the remaining lines at once
+DIFF_WINDOW = 256
+DIFF_WINDOW_HUNKS = 64
+
+# Numbers compared by the numeric comparison may differ by this much
+# relative to the larger of them, or absolutely when both are below 1
+NUMERIC_TOLERANCE = 1e-6
+
 
 def dmp_to_mdiff(diffs):
     """Convert from diff_match_patch format to _mdiff format.
@@ -127,16 +155,43 @@ class TextOutput(Renderable):
             self.custom_output = '<pre><code>{}</code></pre>'.format(content)
 
 
+class DiffSummary(object):
+    """Stands in for a diff using only its summary stored in the database.
+
+    The diff's table can only be rendered by loading the diff itself.
+
+    """
+
+    def __init__(self, issue, lines, first_line, partial=False):
+        self.issue = issue
+        self.lines = lines
+        self.first_line = first_line
+        self.partial = partial
+
+    def get_issue(self):
+        return DIFF_ISSUES.get(self.issue)
+
+    def outputs_match(self):
+        return self.issue is None
+
+    def show_diff_table(self):
+        """Mirror Diff.show_diff_table."""
+        return not self.outputs_match() and \
+            self.issue not in ('no_output', 'pending')
+
+
 class Diff(object):
     """Represents a saved diff file.  Can be pickled safely."""
 
-    def __init__(self, correct, given):
+    partial = False  # Whether only the start of the diff was computed
+
+    def __init__(self, correct, given, engine='dmp'):
         self._tabsize = 8
         self._correct_empty = correct == ""
         self._given_empty = given == ""
         self._correct_newline = correct.endswith('\n')
         self._given_newline = given.endswith('\n')
-        self._diff = self._make_diff(correct, given) \
+        self._diff = self._make_diff(correct, given, engine) \
             if correct != given else None
 
     @property
@@ -193,6 +248,10 @@ class Diff(object):
             pprint.pprint(self._diff)
             return None
 
+    def iter_diff(self):
+        """Return an iterator over the rows of the line by line diff."""
+        return iter(self._diff or ())
+
     def outputs_match(self):
         return self._diff is None
 
@@ -206,27 +265,520 @@ class Diff(object):
             (self.given_empty and not self.correct_empty)
 
     def get_issue(self):
+        return DIFF_ISSUES.get(self.issue_code())
+
+    def issue_code(self):
+        """Return the key into DIFF_ISSUES describing the diff, if any."""
         if self.correct_empty and not self.given_empty:
-            return 'Your program should not have produced output.'
+            return 'extra_output'
         elif self.given_empty and not self.correct_empty:
-            return 'Your program should have produced output.'
+            return 'no_output'
         elif self.correct_newline and self.given_newline is False:
-            return 'Your program\'s output should end with a newline.'
+            return 'missing_newline'
         elif self.correct_newline is False and self.given_newline:
-            return 'Your program\'s output should not end with a newline.'
+            return 'extra_newline'
         elif not self.outputs_match():
-            return 'Your program\'s output did not match the expected.'
+            return 'mismatch'
         return None
 
-    def _make_diff(self, correct, given):
+    def summary(self):
+        """Return the (issue code, differing lines, first line, partial) of
+        the diff.
+
+        The first line is the line number, in the expected output if
+        possible, of the first differing line. A partial diff ends with the
+        remaining lines of both outputs, which are not counted as they were
+        never diffed, thus its differing lines are only a lower bound.
+
+        """
+        lines = 0
+        tail = 0  # Differing lines since the last equal line
+        first_line = None
+        for (left_no, _), (right_no, _), differs in self.iter_diff():
+            if differs:
+                lines += 1
+                tail += 1
+                if first_line is None:
+                    first_line = left_no or right_no or None
+            else:
+                tail = 0
+        if self.partial:
+            lines -= tail
+        return self.issue_code(), lines, first_line, self.partial
+
+    def _make_diff(self, correct, given, engine='dmp'):
         """Return the intermediate representation of the diff."""
-        dmp = DMP()
-        dmp.Diff_Timeout = 4
-        text1, text2, array = dmp.diff_linesToChars(correct, given)
-        diffs = dmp.diff_main(text1, text2)
-        dmp.diff_cleanupSemantic(diffs)
-        dmp.diff_charsToLines(diffs, array)
-        return list(dmp_to_mdiff(diffs))
+        return list(dmp_to_mdiff(line_diff(correct, given, engine)))
+
+
+class CompactDiff(Diff):
+    """A diff saved as runs over the expected output and the inserted text.
+
+    Equal and deleted runs are lengths into the expected output, which is
+    already stored as its own file, so only inserted text is saved with the
+    diff. The line by line representation used for rendering is only built,
+    and the expected output only read, when `_diff` is first accessed.
+
+    The saved format is a `DIFF_HEADER` line, a line of JSON holding the
+    expected output's sha1, the flags and the runs, and the inserted text.
+
+    With `max_hunks` the diff is only computed up to the hunk after which
+    students can no longer see it, see `partial_line_diff`, and `full`
+    returns the complete diff.
+
+    """
+
+    def __init__(self, correct, given, expected_sha1, engine='dmp',
+                 max_hunks=None):
+        self._tabsize = 8
+        self._correct_empty = correct == ""
+        self._given_empty = given == ""
+        self._correct_newline = correct.endswith('\n')
+        self._given_newline = given.endswith('\n')
+        self._expected_sha1 = expected_sha1
+        self._read_expected = lambda: correct
+        self._mdiff = None
+        self._engine = engine
+        if correct == given:
+            chunks = []
+        elif max_hunks is None:
+            chunks = line_diff(correct, given, engine)
+        else:
+            chunks, self.partial = partial_line_diff(correct, given,
+                                                     max_hunks, engine)
+        self._ops = [(x[0], len(x[1])) for x in chunks]
+        self._inserted = ''.join(x[1] for x in chunks
+                                 if x[0] == DMP.DIFF_INSERT)
+
+    @classmethod
+    def loads(cls, data, read_file):
+        """Return the CompactDiff saved in data.
+
+        `read_file` is called with the expected output's sha1 and must
+        return its contents.
+
+        """
+        header, meta, inserted = data.split('\n', 2)
+        if header != DIFF_HEADER:
+            raise ValueError('Unsupported diff format: {}'.format(header))
+        meta = json.loads(meta)
+        diff = cls.__new__(cls)
+        diff._tabsize = 8
+        (diff._correct_empty, diff._given_empty, diff._correct_newline,
+         diff._given_newline) = meta['flags']
+        diff._expected_sha1 = meta['expected']
+        diff._read_expected = lambda: read_file(meta['expected'])
+        diff._mdiff = None
+        diff._ops = [tuple(x) for x in meta['ops']]
+        diff._inserted = inserted
+        diff._engine = meta.get('engine', 'dmp')
+        diff.partial = meta.get('partial', False)
+        return diff
+
+    @classmethod
+    def from_legacy(cls, diff):
+        """Return a (CompactDiff, expected output) pair for a pickled Diff.
+
+        The expected output is rebuilt from the diff as the test case's
+        current expected output may have changed since. Raise ValueError if
+        the diff was not produced by `dmp_to_mdiff`.
+
+        """
+        def unmark(data, marker):
+            if data.startswith('\0' + marker) and data.endswith('\1'):
+                return data[2:-1]
+            raise ValueError('Unexpected line: {!r}'.format(data))
+
+        def flush():
+            # dmp_to_mdiff pairs up all deletions and insertions between two
+            # equal lines regardless of their original order
+            for op, lines in ((DMP.DIFF_DELETE, deleted),
+                              (DMP.DIFF_INSERT, inserted)):
+                if lines:
+                    chunks.append((op, ''.join(lines)))
+                    del lines[:]
+
+        chunks = []
+        deleted = []
+        inserted = []
+        for (left_no, left), (right_no, right), differs in diff._diff or []:
+            if differs:
+                if left_no != '':
+                    deleted.append(unmark(left, '-'))
+                if right_no != '':
+                    inserted.append(unmark(right, '+'))
+            elif left != right:
+                raise ValueError('Mismatched equal lines')
+            else:
+                flush()
+                if chunks and chunks[-1][0] == DMP.DIFF_EQUAL:
+                    chunks[-1] = (DMP.DIFF_EQUAL, chunks[-1][1] + left)
+                else:
+                    chunks.append((DMP.DIFF_EQUAL, left))
+        flush()
+        expected = ''.join(x[1] for x in chunks if x[0] != DMP.DIFF_INSERT)
+        compact = cls.__new__(cls)
+        compact._tabsize = 8
+        compact._correct_empty = diff.correct_empty
+        compact._given_empty = diff.given_empty
+        compact._correct_newline = diff.correct_newline
+        compact._given_newline = diff.given_newline
+        compact._expected_sha1 = None
+        compact._read_expected = lambda: expected
+        compact._mdiff = None
+        compact._ops = [(x[0], len(x[1])) for x in chunks]
+        compact._inserted = ''.join(x[1] for x in chunks
+                                    if x[0] == DMP.DIFF_INSERT)
+        compact._engine = 'dmp'
+        return compact, expected
+
+    @property
+    def _diff(self):
+        if not self._ops:
+            return None
+        if self._mdiff is None:
+            self._mdiff = list(self.iter_diff())
+        return self._mdiff
+
+    def iter_diff(self):
+        """Return a generator over the rows of the line by line diff.
+
+        Rows are only produced as they are consumed.
+
+        """
+        if self._mdiff is not None:
+            return iter(self._mdiff)
+        return dmp_to_mdiff(self._iter_chunks())
+
+    def _iter_chunks(self):
+        expected = self._read_expected()
+        expected_pos = inserted_pos = 0
+        for op, length in self._ops:
+            if op == DMP.DIFF_INSERT:
+                yield op, self._inserted[inserted_pos:inserted_pos + length]
+                inserted_pos += length
+            else:
+                yield op, expected[expected_pos:expected_pos + length]
+                expected_pos += length
+
+    def dumps(self, expected_sha1=None):
+        """Return the diff in its saved format."""
+        meta = {'expected': expected_sha1 or self._expected_sha1,
+                'flags': [self._correct_empty, self._given_empty,
+                          self._correct_newline, self._given_newline],
+                'ops': self._ops}
+        if self.partial:
+            meta.update(engine=self._engine, partial=True)
+        return '\n'.join((DIFF_HEADER, json.dumps(meta), self._inserted))
+
+    def full(self):
+        """Return the complete diff of a partial diff.
+
+        The given output is rebuilt from the partial diff's runs.
+
+        """
+        if not self.partial:
+            return self
+        given = ''.join(text for op, text in self._iter_chunks()
+                        if op != DMP.DIFF_DELETE)
+        return CompactDiff(self._read_expected(), given, self._expected_sha1,
+                           self._engine)
+
+    def outputs_match(self):
+        return not self._ops
+
+
+def line_diff(correct, given, engine='dmp'):
+    """Return the line diff of the two outputs using the named engine.
+
+    Every engine returns a list of (op, text) pairs in diff_match_patch's
+    format whose text is made of whole lines.
+
+    """
+    return DIFF_ENGINES[engine](correct, given)
+
+
+def partial_line_diff(correct, given, max_hunks, engine='dmp'):
+    """Return the line diff of the two outputs up to its max_hunks-th hunk
+    deleting expected lines, and whether it was stopped there.
+
+    Each hunk is found by diffing DIFF_WINDOW lines of each output following
+    their common lines with the named engine, doubling the window until the
+    hunk ends within it. Once max_hunks such hunks are found the remaining
+    lines are reported as deleted and inserted as a whole. After
+    DIFF_WINDOW_HUNKS hunks the remaining lines are diffed at once instead.
+
+    """
+    def append(op, lines):
+        if not lines:
+            return
+        if chunks and chunks[-1][0] == op:
+            chunks[-1] = (op, chunks[-1][1] + ''.join(lines))
+        else:
+            chunks.append((op, ''.join(lines)))
+
+    correct_lines = split_lines(correct)
+    given_lines = split_lines(given)
+    chunks = []
+    correct_pos = given_pos = 0
+    hunks = deleting_hunks = 0
+    while True:
+        start = correct_pos
+        while correct_pos < len(correct_lines) and \
+                given_pos < len(given_lines) and \
+                correct_lines[correct_pos] == given_lines[given_pos]:
+            correct_pos += 1
+            given_pos += 1
+        append(DMP.DIFF_EQUAL, correct_lines[start:correct_pos])
+        partial = correct_pos < len(correct_lines) and \
+            given_pos < len(given_lines)
+        if not partial or deleting_hunks >= max_hunks:
+            append(DMP.DIFF_DELETE, correct_lines[correct_pos:])
+            append(DMP.DIFF_INSERT, given_lines[given_pos:])
+            return chunks, partial
+
+        size = DIFF_WINDOW if hunks < DIFF_WINDOW_HUNKS else \
+            max(len(correct_lines), len(given_lines))
+        while True:
+            window = line_diff(
+                ''.join(correct_lines[correct_pos:correct_pos + size]),
+                ''.join(given_lines[given_pos:given_pos + size]), engine)
+            if correct_pos + size >= len(correct_lines) and \
+                    given_pos + size >= len(given_lines):
+                for op, text in window:  # The remaining lines were diffed
+                    append(op, [text])
+                return chunks, False
+            hunk = list(takewhile(lambda x: x[0] != DMP.DIFF_EQUAL, window))
+            if len(hunk) < len(window):
+                break
+            size *= 2
+        for op, text in hunk:
+            append(op, [text])
+            if op == DMP.DIFF_INSERT:
+                given_pos += len(split_lines(text))
+            else:
+                correct_pos += len(split_lines(text))
+        hunks += 1
+        if any(op == DMP.DIFF_DELETE for op, _ in hunk):
+            deleting_hunks += 1
+
+
+def dmp_line_diff(correct, given):
+    """Return the diff_match_patch line mode diff of the two outputs."""
+    dmp = DMP()
+    dmp.Diff_Timeout = 4
+    text1, text2, array = dmp.diff_linesToChars(correct, given)
+    diffs = dmp.diff_main(text1, text2)
+    dmp.diff_cleanupSemantic(diffs)
+    dmp.diff_charsToLines(diffs, array)
+    return diffs
+
+
+def fast_line_diff(correct, given):
+    """Return the line diff of the two outputs with bounded work.
+
+    Common leading and trailing lines are trimmed and the remaining lines
+    are compared by their hash using Myers' algorithm. Once the work done
+    exceeds DIFF_MIN_WORK plus DIFF_WORK_PER_LINE for each remaining line,
+    the remaining lines are reported as deleted and inserted as a whole.
+
+    """
+    def append(op, lines):
+        if lines:
+            chunks.append((op, ''.join(lines)))
+
+    correct_lines = split_lines(correct)
+    given_lines = split_lines(given)
+    limit = min(len(correct_lines), len(given_lines))
+    start = 0
+    while start < limit and correct_lines[start] == given_lines[start]:
+        start += 1
+    end = 0
+    while end < limit - start and \
+            correct_lines[-1 - end] == given_lines[-1 - end]:
+        end += 1
+    correct_stop = len(correct_lines) - end
+    given_stop = len(given_lines) - end
+
+    hashes = {}
+    a = [hashes.setdefault(x, len(hashes))
+         for x in correct_lines[start:correct_stop]]
+    b = [hashes.setdefault(x, len(hashes))
+         for x in given_lines[start:given_stop]]
+    runs = None
+    if set(a).intersection(b):  # Otherwise every line differs
+        runs = myers_runs(a, b, DIFF_MIN_WORK +
+                          DIFF_WORK_PER_LINE * (len(a) + len(b)))
+    if runs is None:
+        runs = [(DMP.DIFF_DELETE, len(a)), (DMP.DIFF_INSERT, len(b))]
+
+    chunks = []
+    append(DMP.DIFF_EQUAL, correct_lines[:start])
+    correct_pos = given_pos = start
+    for op, count in runs:
+        if op == DMP.DIFF_INSERT:
+            append(op, given_lines[given_pos:given_pos + count])
+            given_pos += count
+        else:
+            append(op, correct_lines[correct_pos:correct_pos + count])
+            correct_pos += count
+            if op == DMP.DIFF_EQUAL:
+                given_pos += count
+    append(DMP.DIFF_EQUAL, correct_lines[correct_stop:])
+    return chunks
+
+
+def myers_runs(a, b, max_work):
+    """Return the shortest edit script from sequence a to sequence b.
+
+    The script is a list of (op, count) runs where deletions precede
+    insertions between equal runs. Return None when finding it takes more
+    than max_work steps.
+
+    """
+    n, m = len(a), len(b)
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    work = 0
+    for d in range(n + m + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or k != d and v[offset + k - 1] < v[offset + k + 1]:
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+                work += 1
+            v[offset + k] = x
+            work += 1
+            if x >= n and y >= m:
+                break
+        else:
+            trace.append(v[offset - d:offset + d + 1])
+            if work > max_work:
+                return None
+            continue
+        break
+
+    # Walk back from (n, m) through the saved frontiers
+    edits = []
+    x, y = n, m
+    for d in range(d, 0, -1):
+        prev = trace[d - 1]
+        k = x - y
+        if k == -d or k != d and prev[k + d - 2] < prev[k + d]:
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = prev[prev_k + d - 1]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            edits.append(DMP.DIFF_EQUAL)
+            x -= 1
+            y -= 1
+        edits.append(DMP.DIFF_INSERT if x == prev_x else DMP.DIFF_DELETE)
+        x, y = prev_x, prev_y
+    edits.extend([DMP.DIFF_EQUAL] * x)
+
+    def flush():
+        for op in (DMP.DIFF_DELETE, DMP.DIFF_INSERT):
+            if changes[op]:
+                runs.append((op, changes[op]))
+                changes[op] = 0
+
+    runs = []
+    changes = {DMP.DIFF_DELETE: 0, DMP.DIFF_INSERT: 0}
+    for op in reversed(edits):
+        if op != DMP.DIFF_EQUAL:
+            changes[op] += 1
+            continue
+        flush()
+        if runs and runs[-1][0] == op:
+            runs[-1] = (op, runs[-1][1] + 1)
+        else:
+            runs.append((op, 1))
+    flush()
+    return runs
+
+
+def split_lines(text):
+    """Split text after each newline as diff_match_patch does."""
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [x + '\n' for x in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+DIFF_ENGINES = {'dmp': dmp_line_diff, 'fast': fast_line_diff}
+
+
+def case_insensitive_lines(lines):
+    for line in lines:
+        yield line.lower()
+
+
+def numbers_close(expected, given):
+    """Return whether the tokens are equal or are numbers close enough."""
+    if expected == given:
+        return True
+    try:
+        expected, given = float(expected), float(given)
+    except ValueError:
+        return False
+    return abs(expected - given) <= \
+        NUMERIC_TOLERANCE * max(1., abs(expected), abs(given))
+
+
+def outputs_equivalent(expected, given, comparison):
+    """Return whether the outputs match under the named comparison.
+
+    The outputs are iterables of lines, such as open files. Each is
+    normalized as it is read and reading stops at the first difference,
+    thus a single pass is made over the outputs.
+
+    """
+    normalize, same = COMPARISONS[comparison]
+    missing = object()
+    for expected_item, given_item in izip_longest(
+            normalize(expected), normalize(given), fillvalue=missing):
+        if expected_item is missing or given_item is missing or \
+                not same(expected_item, given_item):
+            return False
+    return True
+
+
+def stripped_lines(lines):
+    """Yield the lines without their trailing whitespace."""
+    for line in lines:
+        yield line.rstrip()
+
+
+def whitespace_tokens(lines):
+    """Yield the words of the lines, thus all whitespace is alike."""
+    for line in lines:
+        for token in line.split():
+            yield token
+
+
+# Maps each comparison, besides exact, to how it normalizes outputs and how
+# it compares their normalized items
+COMPARISONS = {
+    'case': (case_insensitive_lines, operator.eq),
+    'numeric': (whitespace_tokens, numbers_close),
+    'trailing_whitespace': (stripped_lines, operator.eq),
+    'whitespace': (whitespace_tokens, operator.eq)}
+
+
+def load_diff(data, read_file):
+    """Return the Diff saved in data, either compact or pickled."""
+    if data.startswith(DIFF_HEADER + '\n'):
+        return CompactDiff.loads(data, read_file)
+    return pickle.loads(data)
 
 
 def esc(string):
@@ -1,7 +1,6 @@
 import dateutil.parser
 import json
 import ldap
-import pickle
 import pika
 import re
 import traceback
@@ -355,15 +354,9 @@ def prev_next_group(project, group):
     project's groups with respect to the passed in group.
 
     """
-    # TODO: Profile and optimize this query if necessary
-    groups = sorted(x for x in project.groups if x.submissions)
-    try:
-        index = groups.index(group)
-    except ValueError:
+    if group.project_id != project.id:
         return None, None
-    prev_group = groups[index - 1] if index > 0 else None
-    next_group = groups[index + 1] if index + 1 < len(groups) else None
-    return prev_group, next_group
+    return group.adjacent_groups()
 
 
 def project_file_create(request, file_, filename, project, cls):
@@ -431,8 +424,14 @@ def test_case_verification(function):
     return wrapped
 
 
-def prepare_renderable(request, test_case_result, is_admin):
-    """Return a completed Renderable."""
+def prepare_renderable(request, test_case_result, is_admin,
+                       summary_only=False):
+    """Return a completed Renderable.
+
+    With `summary_only` a diff is represented by its summary, when stored,
+    rather than by loading the diff file.
+
+    """
     test_case = test_case_result.test_case
     file_directory = request.registry.settings['file_directory']
     sha1 = test_case_result.diff.sha1 if test_case_result.diff else None
@@ -451,13 +450,25 @@ def prepare_renderable(request, test_case_result, is_admin):
             with open(File.file_path(file_directory, sha1)) as fp:
                 content = fp.read()
         return TextOutput(content=content, **kwargs)
+    elif test_case_result.output_id is not None:  # Diff not yet computed
+        return DiffWithMetadata(diff=DiffSummary('pending', None, None),
+                                **kwargs)
     elif not test_case_result.diff:  # Outputs match
         return DiffWithMetadata(diff=None, **kwargs)
+    elif summary_only and test_case_result.diff_lines is not None:
+        diff = DiffSummary(test_case_result.diff_issue,
+                           test_case_result.diff_lines,
+                           test_case_result.diff_first_line,
+                           test_case_result.diff_partial)
+        return DiffWithMetadata(diff=diff, **kwargs)
+
+    def read_file(sha1sum):
+        with open(File.file_path(file_directory, sha1sum)) as fp:
+            return fp.read()
 
     try:
-        with open(File.file_path(file_directory, sha1)) as fp:
-            diff = pickle.load(fp)
-    except (AttributeError, EOFError):
+        diff = load_diff(read_file(sha1), read_file)
+    except (AttributeError, EOFError, ValueError):
         content = 'submit system mismatch -- requeue submission'
         content += traceback.format_exc(1)
         return TextOutput(content=content, **kwargs)
@@ -466,6 +477,8 @@ def prepare_renderable(request, test_case_result, is_admin):
         content += traceback.format_exc(1)
         return TextOutput(content=content, **kwargs)
 
+    if is_admin and diff.partial:  # Only computed as far as students see
+        diff = diff.full()
     diff.hide_expected = not is_admin and test_case.hide_expected
     return DiffWithMetadata(diff=diff, **kwargs)
 
@@ -495,6 +508,7 @@ def zip_response(request, filename, files):
 
 
 # Avoid cyclic import
-from .diff_unit import DiffWithMetadata, ImageOutput, TextOutput
+from .diff_unit import (DiffSummary, DiffWithMetadata, ImageOutput,
+                        TextOutput, load_diff)
 from .models import (BuildFile, File, FileVerifier, PasswordReset, Session,
                      Submission, User)
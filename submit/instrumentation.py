@@ -0,0 +1,143 @@
+import heapq
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_request
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+
+class QueryStats(object):
+
+    """The queries issued for a single request."""
+
+    SLOWEST = 3  # Number of the slowest statements kept
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.slowest = []  # A heap of (seconds, statement)
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.time += seconds
+        if len(self.slowest) < self.SLOWEST:
+            heapq.heappush(self.slowest, (seconds, statement))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, statement))
+
+    def slowest_statements(self):
+        """Return the (seconds, statement) of the slowest statements."""
+        return sorted(self.slowest, reverse=True)
+
+
+class RouteStats(object):
+
+    """Keep recent request samples of each route to report percentiles.
+
+    Only the last `samples` requests of each route are kept. The samples
+    belong to the process that handled the requests.
+
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, samples=1000):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.samples = samples
+
+    def add(self, route, queries, db_time, total_time):
+        with self.lock:
+            if route not in self.routes:
+                self.routes[route] = deque(maxlen=self.samples)
+            self.routes[route].append((queries, db_time, total_time))
+
+    def percentiles(self):
+        """Return a dictionary of the percentiles of each route."""
+        with self.lock:
+            routes = {x: list(y) for x, y in self.routes.items()}
+        retval = {}
+        for route, samples in routes.items():
+            retval[route] = {'requests': len(samples)}
+            for i, name in enumerate(('queries', 'db_time', 'time')):
+                values = sorted(x[i] for x in samples)
+                retval[route][name] = {
+                    'p{}'.format(x): values[min(len(values) - 1,
+                                                len(values) * x // 100)]
+                    for x in self.PERCENTILES}
+        return retval
+
+
+def count_queries(engine):
+    """Record the queries issued for each request as `request.query_stats`."""
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_start', []).append(time.time())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        seconds = time.time() - conn.info['query_start'].pop()
+        request = get_current_request()
+        if request is None:
+            return
+        if not hasattr(request, 'query_stats'):
+            request.query_stats = QueryStats()
+        request.query_stats.add(statement, seconds)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def query_stats_tween_factory(handler, registry):
+    """Report the queries issued while handling each request.
+
+    With the `query_stats_headers` setting the request's query count, total
+    query time and slowest statements are added to the response headers, and
+    with `query_stats_log` they are logged as a line of JSON. Those slowest
+    statements taking longer than `query_stats_slow_seconds` are always
+    logged as warnings. Every request is added to `registry.route_stats`.
+
+    """
+    settings = registry.settings
+    headers = asbool(settings.get('query_stats_headers', False))
+    log_requests = asbool(settings.get('query_stats_log', False))
+    slow_seconds = float(settings.get('query_stats_slow_seconds', 1))
+
+    def one_line(statement, length=256):
+        return re.sub(r'\s+', ' ', statement).strip()[:length]
+
+    def query_stats_tween(request):
+        start = time.time()
+        response = handler(request)
+        total_time = time.time() - start
+        stats = getattr(request, 'query_stats', None) or QueryStats()
+        route = request.matched_route.name if request.matched_route \
+            else None
+        registry.route_stats.add(route, stats.count, stats.time, total_time)
+        slowest = stats.slowest_statements()
+        for seconds, statement in slowest:
+            if seconds > slow_seconds:
+                log.warning('Slow query ({:.3f}s) for {}: {}'.format(
+                    seconds, request.path, one_line(statement, 1024)))
+        if headers:
+            response.headers[str('X-Query-Count')] = str(stats.count)
+            response.headers[str('X-Query-Time')] = str(
+                '{:.3f}'.format(stats.time))
+            for i, (seconds, statement) in enumerate(slowest, start=1):
+                response.headers[str('X-Query-Slowest-{}'.format(i))] = \
+                    str('{:.3f} {}'.format(seconds, one_line(statement)))
+        if log_requests:
+            log.info(json.dumps({
+                'route': route, 'method': request.method,
+                'status': response.status_int, 'queries': stats.count,
+                'db_time': round(stats.time, 6),
+                'time': round(total_time, 6),
+                'slowest': [[round(x, 6), one_line(y)] for x, y in slowest]}))
+        return response
+    return query_stats_tween
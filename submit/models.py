@@ -12,10 +12,11 @@ from pyramid_addons.helpers import UTC
 from sqla_mixins import BasicBase, UserMixin
 from sqlalchemy import (Binary, Boolean, Column, DateTime, Enum, ForeignKey,
                         Integer, PickleType, String, Table, Unicode,
-                        UnicodeText, and_, func)
+                        UnicodeText, and_, exists, func, or_)
 from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import backref, relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import (aliased, backref, joinedload, relationship,
+                            scoped_session, sessionmaker, subqueryload)
 from sqlalchemy.schema import UniqueConstraint
 from zope.sqlalchemy import ZopeTransactionExtension
 from .exceptions import GroupWithException
@@ -157,6 +158,27 @@ class File(BasicBase, Base):
             Session.flush()
         return file_
 
+    @staticmethod
+    def fetch_or_create_many(datas, base_path):
+        """Return a dictionary mapping the sha1 of each data to its File.
+
+        Existing files are fetched with a single query and all missing files
+        are created with a single flush.
+
+        """
+        by_sha1 = {sha1(x).hexdigest(): x for x in datas}
+        if not by_sha1:
+            return {}
+        files = {x.sha1: x for x in Session.query(File).filter(
+            File.sha1.in_(by_sha1.keys()))}
+        new = [File(base_path=base_path, data=data, sha1=sha1sum)
+               for sha1sum, data in by_sha1.items() if sha1sum not in files]
+        if new:
+            Session.add_all(new)
+            Session.flush()
+            files.update((x.sha1, x) for x in new)
+        return files
+
     @staticmethod
     def file_path(base_path, sha1sum):
         first = sha1sum[:2]
@@ -213,6 +235,10 @@ class File(BasicBase, Base):
                           in self.test_case_result_for)
             if classes.intersection(user.admin_for):
                 return True
+            classes = set(x.test_case.testable.project.class_ for x
+                          in self.output_for)
+            if classes.intersection(user.admin_for):
+                return True
         return False
 
 
@@ -290,6 +316,42 @@ class Group(BasicBase, Base):
         """Compare the first users in sorted order."""
         return sorted(self.users)[0] < sorted(other.users)[0]
 
+    def adjacent_groups(self):
+        """Return the (previous, next) groups, or None, of the project.
+
+        Groups are ordered by their first users, as `__lt__` orders them, and
+        only groups with a submission are considered. Each neighbor is found
+        by a single query for the nearest first user of such a group rather
+        than by loading and sorting every group.
+
+        """
+        if not Session.query(exists().where(Submission.group_id == self.id))\
+                .scalar():
+            return None, None
+        first = sorted(self.users)[0]
+        other = aliased(UserToGroup)
+        other_user = aliased(User)
+        is_first_user = ~exists().where(and_(
+            other.group_id == UserToGroup.group_id,
+            other.user_id == other_user.id,
+            or_(other_user.name < User.name,
+                and_(other_user.name == User.name,
+                     other_user.username < User.username))))
+        query = (Session.query(Group)
+                 .join(UserToGroup, UserToGroup.group_id == Group.id)
+                 .join(User, User.id == UserToGroup.user_id)
+                 .filter(UserToGroup.project_id == self.project_id,
+                         is_first_user,
+                         exists().where(Submission.group_id == Group.id)))
+        before = or_(User.name < first.name, and_(
+            User.name == first.name, User.username < first.username))
+        after = or_(User.name > first.name, and_(
+            User.name == first.name, User.username > first.username))
+        return (query.filter(before)
+                .order_by(User.name.desc(), User.username.desc()).first(),
+                query.filter(after)
+                .order_by(User.name, User.username).first())
+
     def can_view(self, user):
         """Return whether or not `user` can view info about the group."""
         return user.is_admin or user in self.users \
@@ -399,6 +461,8 @@ class Project(BasicBase, Base):
     deadline = Column(DateTime(timezone=True), nullable=True)
     delay_minutes = Column(Integer, nullable=False, default=1,
                            server_default='1')
+    diff_engine = Column(Enum('dmp', 'fast', name='diff_engine'),
+                         nullable=False, default='dmp', server_default='dmp')
     execution_files = relationship(ExecutionFile, backref='project',
                                    cascade='all, delete-orphan')
     file_verifiers = relationship('FileVerifier', backref='project',
@@ -463,26 +527,39 @@ class Project(BasicBase, Base):
                     if include_hidden or not testable.is_hidden])
 
     def process_submissions(self):
+        """Return the submissions of each group and each group's best.
+
+        Return (by_group, best_ontime, best) where `by_group` maps groups to
+        their submissions in order of creation, while `best_ontime` and
+        `best` map groups without a class admin to the (submission, points)
+        of their earliest submission awarded the most points, including
+        hidden points, before the deadline and at all respectively.
+
+        A single query loads the submissions, with their stored points, and
+        their groups while the database marks the groups with an admin.
+
+        """
+        has_admin = exists().where(and_(
+            UserToGroup.group_id == Submission.group_id,
+            UserToGroup.user_id == user_to_class_admin.c.user_id,
+            user_to_class_admin.c.class_id == self.class_id))
+        rows = (Session.query(Submission, Submission.total_points, has_admin)
+                .options(joinedload(Submission.group))
+                .filter(Submission.project_id == self.id)
+                .order_by(Submission.created_at))
+
         by_group = {}
         best_ontime = {}
         best = {}
-        admins = set(self.class_.admins)
-        for sub in sorted(self.submissions, key=lambda x: x.created_at):
-            is_student = not set(sub.group.users) & admins
-            points = sub.points(include_hidden=True)
-            if sub.group in by_group:
-                by_group[sub.group].append(sub)
-                if is_student:
-                    if points > best[sub.group][1]:
-                        best[sub.group] = sub, points
-                    if not sub.is_late and points > best_ontime[sub.group][1]:
-                        best_ontime[sub.group] = sub, points
-            else:
-                by_group[sub.group] = [sub]
-                if is_student:
-                    best[sub.group] = sub, points
-                    if not sub.is_late:
-                        best_ontime[sub.group] = sub, points
+        for sub, points, is_admin in rows:
+            by_group.setdefault(sub.group, []).append(sub)
+            if is_admin:
+                continue
+            if sub.group not in best or points > best[sub.group][1]:
+                best[sub.group] = sub, points
+            if not sub.is_late and (sub.group not in best_ontime or
+                                    points > best_ontime[sub.group][1]):
+                best_ontime[sub.group] = sub, points
         return by_group, best_ontime, best
 
     def recent_submissions(self):
@@ -513,6 +590,16 @@ class Project(BasicBase, Base):
                               'executable': '', 'hidden': False,
                               'test_cases': []}])
 
+    def update_scores(self):
+        """Recompute the stored scores of every submission.
+
+        Needed whenever the project's testables change.
+
+        """
+        for submission in (Submission.query_by(project=self).options(
+                subqueryload(Submission.testable_results))):
+            submission.update_scores()
+
     def verify_submission(self, base_path, submission, update):
         """Return list of testables that can be built."""
         results = VerificationResults()
@@ -557,6 +644,7 @@ class Project(BasicBase, Base):
             # Set new information
             submission.verification_results = results
             submission.verified_at = func.now()
+            submission.update_scores()
         return retval
 
 
@@ -564,16 +652,24 @@ class Submission(BasicBase, Base):
     created_by = relationship('User')
     created_by_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     group = relationship(Group, backref='submissions')
-    group_id = Column(Integer, ForeignKey('group.id'), nullable=False)
+    group_id = Column(Integer, ForeignKey('group.id'), index=True,
+                      nullable=False)
     files = relationship('SubmissionToFile', backref='submission',
                          cascade='all, delete-orphan')
+    # The scores are maintained as results are stored, see `update_scores`.
+    # Pending testables are unknown (None) until the submission is verified.
+    pending_testables = Column(Integer, nullable=True)
     project_id = Column(Integer, ForeignKey('project.id'), nullable=False)
     test_case_results = relationship('TestCaseResult', backref='submission',
                                      cascade='all, delete-orphan')
     testable_results = relationship('TestableResult', backref='submission',
                                     cascade='all, delete-orphan')
+    total_points = Column(Integer, nullable=False, default=0,
+                          server_default='0')
     verification_results = Column(PickleType)
     verified_at = Column(DateTime(timezone=True), index=True)
+    visible_points = Column(Integer, nullable=False, default=0,
+                            server_default='0')
 
     @property
     def is_late(self):
@@ -588,6 +684,31 @@ class Submission(BasicBase, Base):
                 .filter(Submission.created_at < submission.created_at)
                 .order_by(Submission.created_at.desc()).first())
 
+    @staticmethod
+    def fetch_for_view(submission_id):
+        """Return the submission with everything its results page shows.
+
+        The submission, its group, project and class are fetched by a single
+        query and each collection by one more query. The test cases and
+        testables of the results are then found in the session rather than
+        lazily loaded one at a time.
+
+        """
+        return (Session.query(Submission)
+                .options(joinedload('group'),
+                         subqueryload('group.group_assocs'),
+                         joinedload('group.group_assocs.user'),
+                         joinedload('project'),
+                         joinedload('project.class_'),
+                         subqueryload('project.testables'),
+                         subqueryload('project.testables.test_cases'),
+                         subqueryload('files'),
+                         joinedload('files.file'),
+                         subqueryload('test_case_results'),
+                         joinedload('test_case_results.diff'),
+                         subqueryload('testable_results'))
+                .filter(Submission.id == submission_id).one())
+
     @staticmethod
     def later_submission_for_group(submission):
         """Return the submission immediately prior to the given submission."""
@@ -660,10 +781,36 @@ class Submission(BasicBase, Base):
                 self._delay = min(delay, pv_delay).total_seconds() / 60
         return self._delay
 
+    def has_pending_testables(self):
+        """Return whether testables that can execute have yet to."""
+        if self.pending_testables is not None:
+            return self.pending_testables > 0
+        return bool(self.testables_pending())
+
     def points(self, include_hidden=False):
         """Return the number of points awarded to this submission."""
-        return sum(x.points for x in self.testable_results
-                   if include_hidden or not x.testable.is_hidden)
+        return self.total_points if include_hidden else self.visible_points
+
+    def record_testable_result(self, testable, points, previous_points):
+        """Adjust the stored scores for a new result of `testable`.
+
+        `previous_points` are those of the result it replaces, or None when
+        the testable had no result. The scores are updated in place by the
+        database so that concurrent updates cannot be lost.
+
+        """
+        delta = points - (previous_points or 0)
+        changes = {Submission.total_points: Submission.total_points + delta}
+        if not testable.is_hidden:
+            changes[Submission.visible_points] = \
+                Submission.visible_points + delta
+        if previous_points is None:
+            changes[Submission.pending_testables] = \
+                Submission.pending_testables - 1
+        Session.query(Submission).filter_by(id=self.id).update(
+            changes, synchronize_session=False)
+        Session.expire(self, ['pending_testables', 'total_points',
+                              'visible_points'])
 
     def testables_pending(self, prune=False):
         """Return the set of testables that _can_ execute and have yet to.
@@ -688,7 +835,7 @@ class Submission(BasicBase, Base):
         fmt = '<a href="{url}">{created}</a>{name} {score} {modifier}'
         if not self.verification_results:
             score = '<span class="label">waiting to verify submission</span>'
-        elif self.testables_pending():
+        elif self.has_pending_testables():
             score = '<span class="label">waiting for results</span>'
         elif not admin and self.get_delay(update=False):
             score = '<span class="label">waiting for delay to expire</span>'
@@ -720,6 +867,14 @@ class Submission(BasicBase, Base):
         return fmt.format(url=url, created=self.created_at,
                           name=name, score=score, modifier=modifier)
 
+    def update_scores(self):
+        """Recompute the stored scores from the testable results."""
+        self.total_points = sum(x.points for x in self.testable_results)
+        self.visible_points = sum(x.points for x in self.testable_results
+                                  if not x.testable.is_hidden)
+        self.pending_testables = len(self.testables_pending()) \
+            if self.verification_results else None
+
     def verify(self, base_path, update=False):
         """Verify the submission and return testables that can be executed."""
         return self.project.verify_submission(base_path, self, update=update)
@@ -740,6 +895,10 @@ class SubmissionToFile(Base):
 class TestCase(BasicBase, Base):
     __table_args__ = (UniqueConstraint('name', 'testable_id'),)
     args = Column(Unicode, nullable=False)
+    comparison = Column(Enum('case', 'exact', 'numeric', 'trailing_whitespace',
+                             'whitespace', name='comparison'),
+                        nullable=False, default='exact',
+                        server_default='exact')
     expected = relationship(File, primaryjoin='File.id==TestCase.expected_id',
                             backref='expected_for')
     expected_id = Column(Integer, ForeignKey('file.id'), nullable=True)
@@ -770,7 +929,8 @@ class TestCase(BasicBase, Base):
         data = {'id': self.id, 'name': self.name, 'points': self.points,
                 'source': self.source, 'hide_expected': self.hide_expected,
                 'stdin': self.stdin is not None, 'args': self.args,
-                'output_type': self.output_type}
+                'output_type': self.output_type,
+                'comparison': self.comparison}
         return json.dumps(data) if jsonify else data
 
     def serialize(self):
@@ -790,12 +950,28 @@ class TestCaseResult(Base):
     stores the signal number when the status is `signal`.
 
     When the TestCase output_type is not `diff` the diff file is actually
-    the raw output file.
+    the raw output file. Otherwise the diff_ fields summarize the diff file
+    so that the result can be listed without reading it. They are None for
+    results stored before the summary existed. When diff_partial is set only
+    the start of the diff was computed thus diff_lines is a lower bound.
+
+    The output field holds the raw output of a `diff` test case until the
+    diff worker has computed its diff.
 
     """
     __tablename__ = 'testcaseresult'
-    diff = relationship(File, backref='test_case_result_for')
+    diff = relationship(File, primaryjoin='File.id==TestCaseResult.diff_id',
+                        backref='test_case_result_for')
+    diff_first_line = Column(Integer)
     diff_id = Column(Integer, ForeignKey('file.id'), nullable=True)
+    diff_issue = Column(String)
+    diff_lines = Column(Integer)
+    diff_partial = Column(Boolean, default=False, nullable=False,
+                          server_default='0')
+    output = relationship(File,
+                          primaryjoin='File.id==TestCaseResult.output_id',
+                          backref='output_for')
+    output_id = Column(Integer, ForeignKey('file.id'), nullable=True)
     status = Column(Enum('nonexistent_executable', 'output_limit_exceeded',
                          'signal', 'success', 'timed_out',
                          name='status'), nullable=False)
@@ -810,6 +986,15 @@ class TestCaseResult(Base):
         return Session.query(cls).filter_by(
             submission_id=submission_id, test_case_id=test_case_id).first()
 
+    @classmethod
+    def fetch_by_submission(cls, submission_id, test_case_ids):
+        """Return a dictionary mapping test case ids to their results."""
+        if not test_case_ids:
+            return {}
+        return {x.test_case_id: x for x in Session.query(cls).filter(
+            cls.submission_id == submission_id,
+            cls.test_case_id.in_(test_case_ids))}
+
     def update(self, data):
         for attr, val in data.items():
             setattr(self, attr, val)
@@ -874,9 +1059,11 @@ class Testable(BasicBase, Base):
             for tcr in (Session.query(TestCaseResult).filter(
                     and_(TestCaseResult.submission == result.submission,
                          TestCaseResult.test_case_id.in_(tc_ids))).all()):
-                if tcr.status == 'success' and tcr.diff is None:
+                if tcr.status == 'success' and tcr.diff is None and \
+                        tcr.output_id is None:
                     points += tcr.test_case.points
             result.points = points
+            result.submission.update_scores()
 
 
 class TestableResult(BasicBase, Base):
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+
+class RenderCache(object):
+
+    """Cache rendered html fragments on disk with an in-memory LRU front.
+
+    Fragments are stored content-addressed by the sha1 of their key parts
+    under a subdirectory for the renderer `version`, so bumping the version
+    invalidates every fragment; the directories of other versions are
+    removed when the cache is created. Once the fragments on disk exceed
+    `max_size` bytes the least recently used ones are removed.
+
+    """
+
+    EVICT_TO = 0.75  # Fraction of max_size kept on eviction
+
+    def __init__(self, directory, version, max_size=268435456,
+                 max_memory_size=16777216):
+        self.directory = os.path.join(directory, 'v{}'.format(version))
+        self.max_size = max_size
+        self.max_memory_size = max_memory_size
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name.startswith('v') and path != self.directory and \
+                        os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+        self.size = sum(x[1] for x in self._entries())
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(json.dumps(parts)).hexdigest()
+
+    def get(self, key):
+        """Return the fragment stored for key, or None."""
+        with self.lock:
+            if key in self.memory:
+                self.memory[key] = value = self.memory.pop(key)
+                return value
+        path = self._path(key)
+        try:
+            with open(path) as fp:
+                value = fp.read()
+            os.utime(path, None)
+        except (IOError, OSError):  # Missing, or evicted by another process
+            return None
+        self._remember(key, value)
+        return value
+
+    def get_or_render(self, key, render):
+        """Return the fragment for key, calling render() to produce it."""
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        path = self._path(key)
+        tmp_path = '{}.tmp{}_{}'.format(path, os.getpid(),
+                                        threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmp_path, 'w') as fp:
+                fp.write(value)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):  # The fragment will be rendered again
+            return
+        with self.lock:
+            self.size += len(value)
+            evict = self.size > self.max_size
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used fragments from disk."""
+        entries = sorted(self._entries())
+        size = sum(x[1] for x in entries)
+        for _, file_size, path in entries:
+            if size <= self.max_size * self.EVICT_TO:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            size -= file_size
+        with self.lock:
+            self.size = size
+
+    def _entries(self):
+        """Return (last use, size, path) of each fragment on disk."""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((max(stat.st_atime, stat.st_mtime),
+                                stat.st_size, path))
+        return entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def _remember(self, key, value):
+        if len(value) > self.max_memory_size:
+            return
+        with self.lock:
+            if key in self.memory:
+                self.memory_size -= len(self.memory.pop(key))
+            self.memory[key] = value
+            self.memory_size += len(value)
+            while self.memory_size > self.max_memory_size:
+                self.memory_size -= len(self.memory.popitem(last=False)[1])
@@ -1,4 +1,4 @@
-sameIDRegex = /difflib_same_same(\d+)_(\d+)_(\d+)/; // table, block, line
+sameIDRegex = /difflib_same_same(\w+?)_(\d+)_(\d+)/; // table, block, line
 savedRows = {};
 SHOW_HIDE_HREF = "showHideRows( this ); return false;";
 
@@ -190,3 +190,17 @@ function showAll( tableID ) {
 function hideAll( tableID ) {
     toggleShowHide( 'h', document.getElementById( tableID ) );
 }
+
+// replaces the "more" row of a diff table with the next page of the diff
+function loadDiffPage( a ) {
+    var row = $( a ).closest( 'tbody' );
+    $( a ).replaceWith( 'Loading...' );
+    $.getJSON( a.href, function( data ) {
+	var table = $( $.parseHTML( $.trim( data.html ) ) );
+	row.closest( 'table' ).after( table );
+	row.remove();
+	toggleShowHide( 'h', table[ 0 ] );
+    } ).fail( function() {
+	row.find( 'td' ).last().text( 'Failed to load more lines.' );
+    } );
+}
@@ -143,8 +143,14 @@ table-hover">');
         if (data['output_type'] != 'diff')
             other += '<span class="label label-inverse">{0}</span>'._format(
                 data['output_type']);
-        else if (data['hide_expected'])
-            other += '<span class="label label-important">Hide Expected</span>'
+        else {
+            if (data['hide_expected'])
+                other += ('<span class="label label-important">Hide Expected'
+                          + '</span>');
+            if (data['comparison'] != 'exact')
+                other += '<span class="label label-warning">{0}</span>'
+                    ._format(data['comparison'].replace('_', ' '));
+        }
         $('<tr><td><span class="btn btn-warning btn-mini" onclick="$(\'#update\
 _tc_{0}\').dialog(\'open\');"><i class="icon-white icon-pencil"></i> Edit\
 </span> {1}</td><td>{2}</td></tr>'
@@ -0,0 +1,517 @@
+import json
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import threading
+import transaction
+import unittest
+from pyramid import testing
+from pyramid.renderers import render
+from pyramid.request import apply_request_extensions
+from sqlalchemy import create_engine
+from diff_match_patch import diff_match_patch as DMP
+from . import add_routes
+from .diff_render import MAX_DIFF_LINES, MAX_NUM_REVEALS, \
+    limit_revealed_lines_to
+from .diff_unit import (DIFF_ENGINES, DIFF_WINDOW, NUMERIC_TOLERANCE,
+                        CompactDiff, Diff, fast_line_diff, load_diff,
+                        myers_runs, outputs_equivalent, partial_line_diff)
+from .instrumentation import QueryStats, count_queries
+from .models import (Class, File, Group, Project, Session, Submission,
+                     TestCase, TestCaseResult, Testable, TestableResult, User,
+                     UserToGroup, VerificationResults, configure_sql,
+                     create_schema)
+from .views import submission_view
+from .workers.scheduler import MachineScheduler, MachineStats
+
+
+def random_outputs(rng, lines=30):
+    """Return an expected output and a given output edited from it."""
+    expected = [rng.choice(['a\n', 'b\n', 'c\n', 'dd\n', 'e\r\n'])
+                for _ in range(rng.randint(0, lines))]
+    given = list(expected)
+    for _ in range(rng.randint(0, 6)):
+        index = rng.randint(0, len(given))
+        if given and rng.random() < .5:
+            del given[min(index, len(given) - 1)]
+        else:
+            given.insert(index, rng.choice(['x\n', 'y\n', 'a\n']))
+    given = ''.join(given)
+    if rng.random() < .3:
+        given = given.rstrip('\n')
+    return ''.join(expected), given
+
+
+def unapply(chunks):
+    """Return the (expected, given) outputs a line diff was made of."""
+    return (''.join(x[1] for x in chunks if x[0] != DMP.DIFF_INSERT),
+            ''.join(x[1] for x in chunks if x[0] != DMP.DIFF_DELETE))
+
+
+class FastLineDiffTest(unittest.TestCase):
+
+    """The fast diff engine and the edit scripts it is built on."""
+
+    @staticmethod
+    def lcs_length(a, b):
+        lengths = [0] * (len(b) + 1)
+        for x in a:
+            previous = 0
+            for j, y in enumerate(b):
+                previous, lengths[j + 1] = lengths[j + 1], (
+                    previous + 1 if x == y
+                    else max(lengths[j], lengths[j + 1]))
+        return lengths[-1]
+
+    def test_myers_runs_is_shortest(self):
+        rng = random.Random(1)
+        for _ in range(200):
+            a = [rng.randint(0, 3) for _ in range(rng.randint(0, 20))]
+            b = [rng.randint(0, 3) for _ in range(rng.randint(0, 20))]
+            runs = myers_runs(a, b, 10 ** 6)
+            counts = dict.fromkeys((DMP.DIFF_DELETE, DMP.DIFF_EQUAL,
+                                    DMP.DIFF_INSERT), 0)
+            for op, count in runs:
+                counts[op] += count
+            self.assertEqual(len(a), counts[DMP.DIFF_DELETE] +
+                             counts[DMP.DIFF_EQUAL])
+            self.assertEqual(len(b), counts[DMP.DIFF_INSERT] +
+                             counts[DMP.DIFF_EQUAL])
+            self.assertEqual(self.lcs_length(a, b), counts[DMP.DIFF_EQUAL])
+
+    def test_myers_runs_gives_up(self):
+        self.assertIsNone(myers_runs(range(100), range(100, 0, -1), 100))
+
+    def test_round_trip(self):
+        rng = random.Random(2)
+        for _ in range(300):
+            expected, given = random_outputs(rng)
+            chunks = fast_line_diff(expected, given)
+            self.assertEqual((expected, given), unapply(chunks))
+            for op, text in chunks:
+                self.assertTrue(text)
+                if op == DMP.DIFF_EQUAL:
+                    self.assertIn(text, expected)
+
+    def test_unrelated_outputs(self):
+        self.assertEqual([(DMP.DIFF_EQUAL, 'a\n'), (DMP.DIFF_DELETE, 'b\n'),
+                          (DMP.DIFF_INSERT, 'c\nd\n'),
+                          (DMP.DIFF_EQUAL, 'e\n')],
+                         fast_line_diff('a\nb\ne\n', 'a\nc\nd\ne\n'))
+
+
+class PartialLineDiffTest(unittest.TestCase):
+
+    """Diffing only up to the hunk after which students see no more."""
+
+    @staticmethod
+    def outputs(lines, changed):
+        """Return numbered lines and them with the given lines replaced."""
+        expected = ['{}\n'.format(i) for i in range(lines)]
+        given = list(expected)
+        for start, count in changed:
+            given[start:start + count] = ['changed {}\n'.format(i) for i in
+                                          range(start, start + count)]
+        return ''.join(expected), ''.join(given)
+
+    def test_round_trip(self):
+        rng = random.Random(3)
+        for engine in sorted(DIFF_ENGINES):
+            for _ in range(100):
+                expected, given = random_outputs(rng)
+                for max_hunks in (0, 1, 2, 100):
+                    chunks, _ = partial_line_diff(expected, given, max_hunks,
+                                                  engine)
+                    self.assertEqual((expected, given), unapply(chunks))
+
+    def test_stops_after_max_hunks(self):
+        spacing = DIFF_WINDOW + 44
+        expected, given = self.outputs(3000, [(x, 1) for x in
+                                              range(spacing, 3000, spacing)])
+        for engine in sorted(DIFF_ENGINES):
+            chunks, partial = partial_line_diff(expected, given, 2, engine)
+            self.assertTrue(partial)
+            self.assertEqual([DMP.DIFF_EQUAL, DMP.DIFF_DELETE, DMP.DIFF_INSERT,
+                              DMP.DIFF_EQUAL, DMP.DIFF_DELETE, DMP.DIFF_INSERT,
+                              DMP.DIFF_EQUAL, DMP.DIFF_DELETE,
+                              DMP.DIFF_INSERT], [x[0] for x in chunks])
+            self.assertEqual(('{}\n'.format(spacing), 'changed {}\n'.format(
+                spacing)), unapply(chunks[1:3]))
+            # The remaining lines start at the third differing line
+            self.assertTrue(chunks[-2][1].startswith(
+                '{}\n'.format(3 * spacing)))
+            self.assertEqual((expected, given), unapply(chunks))
+
+            chunks, partial = partial_line_diff(expected, given, 100, engine)
+            self.assertFalse(partial)
+            self.assertEqual(fast_line_diff(expected, given), chunks)
+
+    def test_insertions_are_not_counted(self):
+        expected = ''.join('{}\n'.format(i) for i in range(1000))
+        given = expected.replace('0\n', '0\nnew\n', 50)
+        for engine in sorted(DIFF_ENGINES):
+            chunks, partial = partial_line_diff(expected, given, 1, engine)
+            self.assertFalse(partial)
+            self.assertEqual([], [x for x in chunks
+                                  if x[0] == DMP.DIFF_DELETE])
+            self.assertEqual((expected, given), unapply(chunks))
+
+    def test_window_doubles_to_fit_hunk(self):
+        count = 3 * DIFF_WINDOW
+        expected, given = self.outputs(3000, [(10, count), (2000, 1)])
+        for engine in sorted(DIFF_ENGINES):
+            chunks, partial = partial_line_diff(expected, given, 1, engine)
+            self.assertTrue(partial)
+            self.assertEqual([DMP.DIFF_EQUAL, DMP.DIFF_DELETE, DMP.DIFF_INSERT,
+                              DMP.DIFF_EQUAL, DMP.DIFF_DELETE,
+                              DMP.DIFF_INSERT], [x[0] for x in chunks])
+            self.assertEqual(count, chunks[1][1].count('\n'))
+            self.assertEqual(count, chunks[2][1].count('\n'))
+            self.assertEqual(2000 - 10 - count, chunks[3][1].count('\n'))
+
+
+class CompactDiffTest(unittest.TestCase):
+
+    """Saving diffs as runs over the expected output."""
+
+    def assert_same(self, diff, compact):
+        self.assertEqual(diff._diff, compact._diff)
+        self.assertEqual(diff.summary(), compact.summary())
+        self.assertEqual(diff.show_diff_table(), compact.show_diff_table())
+
+    def test_dumps_loads(self):
+        rng = random.Random(4)
+        for _ in range(200):
+            expected, given = random_outputs(rng)
+            data = CompactDiff(expected, given, 'sha1').dumps()
+            read = []
+            loaded = load_diff(data, lambda x: read.append(x) or expected)
+            self.assertEqual([], read)  # Only read once rows are needed
+            self.assert_same(Diff(expected, given), loaded)
+            self.assertEqual(['sha1'] * len(read), read)
+            self.assertEqual(data, loaded.dumps())
+
+    def test_loads_rejects_unknown_format(self):
+        with self.assertRaises(ValueError):
+            CompactDiff.loads('submit-diff 0\n{}\n', None)
+
+    def test_from_legacy(self):
+        rng = random.Random(5)
+        for _ in range(200):
+            expected, given = random_outputs(rng)
+            diff = pickle.loads(pickle.dumps(Diff(expected, given)))
+            self.assertIsInstance(load_diff(pickle.dumps(diff), None), Diff)
+            compact, rebuilt = CompactDiff.from_legacy(diff)
+            self.assert_same(diff, compact)
+            if expected != given:
+                self.assertEqual(expected, rebuilt)
+            loaded = load_diff(compact.dumps('sha1'), lambda x: rebuilt)
+            self.assert_same(diff, loaded)
+
+    def test_from_legacy_rejects_other_rows(self):
+        diff = Diff('a\n', 'b\n')
+        diff._diff = [((1, 'a\n'), (1, 'b\n'), False)]
+        with self.assertRaises(ValueError):
+            CompactDiff.from_legacy(diff)
+
+    def test_full(self):
+        rng = random.Random(6)
+        for _ in range(200):
+            expected, given = random_outputs(rng)
+            whole = CompactDiff(expected, given, 'sha1')
+            self.assertIs(whole, whole.full())
+            data = CompactDiff(expected, given, 'sha1', max_hunks=0).dumps()
+            partial = load_diff(data, lambda x: expected)
+            full = partial.full()
+            self.assertFalse(full.partial)
+            self.assertEqual((whole._ops, whole._inserted),
+                             (full._ops, full._inserted))
+            if partial.partial:
+                self.assertLessEqual(partial.summary()[1],
+                                     whole.summary()[1])
+
+
+class OutputsEquivalentTest(unittest.TestCase):
+
+    """Each comparison a test case's output can be checked with."""
+
+    def assert_equivalent(self, comparison, expected, given, equivalent=True):
+        self.assertEqual(equivalent, outputs_equivalent(
+            expected.splitlines(True), given.splitlines(True), comparison))
+
+    def test_case(self):
+        self.assert_equivalent('case', 'Hello\nWorld\n', 'hello\nWORLD\n')
+        self.assert_equivalent('case', 'hello\n', 'hello \n', False)
+        self.assert_equivalent('case', 'a\n', 'a\nb\n', False)
+
+    def test_trailing_whitespace(self):
+        self.assert_equivalent('trailing_whitespace', 'a\nb\n',
+                               'a  \nb\t\r\n')
+        self.assert_equivalent('trailing_whitespace', 'a\nb\n', 'a\nb')
+        self.assert_equivalent('trailing_whitespace', 'a\n', ' a\n', False)
+        self.assert_equivalent('trailing_whitespace', 'a b\n', 'a  b\n',
+                               False)
+        # Blank lines are lines too, only whitespace within lines is ignored
+        self.assert_equivalent('trailing_whitespace', 'a\n', 'a\n\n', False)
+        self.assert_equivalent('trailing_whitespace', 'a\n\n', 'a\n', False)
+        self.assert_equivalent('trailing_whitespace', 'a\n\n', 'a\n  \n')
+
+    def test_whitespace(self):
+        self.assert_equivalent('whitespace', 'a b\nc\n', ' a\tb c\n\n')
+        self.assert_equivalent('whitespace', 'ab\n', 'a b\n', False)
+        self.assert_equivalent('whitespace', 'a b\n', 'a b c\n', False)
+
+    def test_numeric(self):
+        self.assert_equivalent('numeric', 'x = 1.5\n', 'x =  1.50\n')
+        self.assert_equivalent('numeric', '1e3 inf\n', '1000 inf\n')
+        self.assert_equivalent('numeric', 'nan\n', 'NaN\n', False)
+        self.assert_equivalent('numeric', 'x 1\n', 'y 1\n', False)
+        self.assert_equivalent('numeric', '1 2\n', '1\n', False)
+
+    def test_numeric_tolerance(self):
+        def close(expected, given):
+            return outputs_equivalent([repr(expected)], [repr(given)],
+                                      'numeric')
+
+        for value in (1e6, -1e6, 1e-12, 2.5):
+            # Relative to the larger number, absolute below 1
+            error = NUMERIC_TOLERANCE * max(1., abs(value))
+            self.assertTrue(close(value, value + error * .99))
+            self.assertTrue(close(value + error * .99, value))
+            self.assertFalse(close(value, value + error * 1.01))
+            self.assertFalse(close(value + error * 1.01, value))
+        self.assertTrue(close(0., NUMERIC_TOLERANCE))
+        self.assertFalse(close(0., 2 * NUMERIC_TOLERANCE))
+        self.assertFalse(close(1e-12, -1e-12 - 2 * NUMERIC_TOLERANCE))
+
+
+class LimitRevealedLinesTest(unittest.TestCase):
+
+    """Paging a diff never shows more of it than the diff cut off at once."""
+
+    @staticmethod
+    def rows(count, deleted=False, every=1):
+        """Return diff rows of which every `every`-th row differs."""
+        rows = []
+        for i in range(1, count + 1):
+            if i % every:
+                rows.append(((i, 'same'), (i, 'same'), False))
+            elif deleted:
+                rows.append(((i, '\0-gone\1'), ('', ''), True))
+            else:
+                rows.append((('', ''), (i, '\0+extra\1'), True))
+        return rows
+
+    @staticmethod
+    def pages(rows, limit):
+        """Return the rows of every page up to the last one."""
+        retval = []
+        page = 0
+        while True:
+            status = {}
+            retval.extend(limit_revealed_lines_to(iter(rows), limit, False,
+                                                  page, status))
+            if not status.get('more'):
+                return retval
+            page += 1
+
+    def assert_cut(self, rows, limit, differing):
+        whole = list(limit_revealed_lines_to(iter(rows), limit, False))
+        self.assertEqual(whole, self.pages(rows, limit))
+        self.assertEqual(differing, sum(1 for x in whole if x[2]))
+        return whole
+
+    def test_differing_lines_are_capped_across_pages(self):
+        whole = self.assert_cut(self.rows(4000), MAX_NUM_REVEALS,
+                                MAX_DIFF_LINES)
+        self.assertEqual('...', whole[-1][0][0])
+
+    def test_reveals_are_capped_across_pages(self):
+        self.assert_cut(self.rows(4000, deleted=True, every=200),
+                        MAX_NUM_REVEALS, MAX_NUM_REVEALS)
+
+    def test_unpaged_diff_keeps_context_rows(self):
+        rows = self.rows(2000, every=10)
+        self.assertEqual(rows, self.assert_cut(rows, MAX_NUM_REVEALS, 200))
+
+
+class MachineSchedulerTest(unittest.TestCase):
+
+    """Picking worker machines by their recent behavior."""
+
+    def test_score(self):
+        stats = MachineStats('a')
+        self.assertEqual(5., stats.score(5., 600., 4.))
+        stats.weight = 2.
+        self.assertEqual(2.5, stats.score(5., 600., 4.))
+        stats.job_time, stats.load, stats.failure_rate = 2., .5, .25
+        self.assertEqual(3., stats.score(5., 600., 4.))
+
+    def test_penalty_decay(self):
+        stats = MachineStats('a')
+        stats.penalty, stats.penalty_time = 8., 100.
+        self.assertEqual(8., stats.current_penalty(600., now=100.))
+        self.assertEqual(4., stats.current_penalty(600., now=700.))
+        self.assertEqual(2., stats.current_penalty(600., now=1300.))
+        self.assertEqual(5. + 2., stats.score(5., 600., 4., now=1300.))
+
+    def test_acquire_prefers_best_score(self):
+        scheduler = MachineScheduler(['slow', 'fast:2', 'fastest:4'])
+        self.assertEqual('fastest', scheduler.acquire())
+        self.assertEqual('fast', scheduler.acquire())
+        self.assertEqual('slow', scheduler.acquire())
+
+    def test_acquire_waits_for_release(self):
+        scheduler = MachineScheduler(['a'])
+        self.assertEqual('a', scheduler.acquire())
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(scheduler.acquire()))
+        thread.start()
+        thread.join(.1)
+        self.assertEqual([], acquired)
+        scheduler.release('a', job_time=1.)
+        thread.join(5)
+        self.assertEqual(['a'], acquired)
+
+    def test_release_averages(self):
+        scheduler = MachineScheduler(['a'], alpha=.5)
+        scheduler.acquire()
+        entry = scheduler.release('a', job_time=10., load=.5)
+        self.assertEqual((10., 0., .5, False), (
+            entry['job_time'], entry['failure_rate'], entry['load'],
+            entry['busy']))
+        scheduler.acquire()
+        entry = scheduler.release('a', job_time=20.)
+        self.assertEqual((15., .5), (entry['job_time'], entry['load']))
+
+    def test_failures(self):
+        scheduler = MachineScheduler(['bad', 'good'])
+        scheduler.machines.sort(key=lambda x: x.name)
+        self.assertEqual('bad', scheduler.acquire())
+        entry = scheduler.release('bad', failed=True, penalty=5.)
+        self.assertEqual((.3, 5.), (entry['failure_rate'], entry['penalty']))
+        self.assertEqual(5. * (1 + 4. * .3) + 5., entry['score'])
+        self.assertEqual('good', scheduler.acquire())
+        # A failure of the job rather than of the machine is not counted
+        scheduler.acquire()
+        entry = scheduler.release('bad', failed=None)
+        self.assertEqual(.3, entry['failure_rate'])
+        entry = scheduler.release('good', job_time=1., failed=False)
+        self.assertEqual(0., entry['failure_rate'])
+        self.assertEqual(['good', 'bad'],
+                         [x['machine'] for x in scheduler.scoreboard()])
+
+    def test_scoreboard_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'scoreboard.json')
+            scheduler = MachineScheduler(['a', 'b'], scoreboard_file=path)
+            entry = scheduler.release(scheduler.acquire(), job_time=1.)
+            with open(path) as fp:
+                board = json.load(fp)
+            self.assertEqual(['a', 'b'], sorted(x['machine'] for x in board))
+            self.assertIn(entry, board)
+            self.assertEqual([], [x for x in os.listdir(directory)
+                                  if x != 'scoreboard.json'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class SubmissionViewQueriesTest(unittest.TestCase):
+
+    """The submission page issues a fixed number of queries."""
+
+    BUDGET = 20  # Queries of the view and its template, whatever the size
+
+    def setUp(self):
+        self.file_directory = tempfile.mkdtemp()
+        self.config = testing.setUp(
+            settings={'file_directory': self.file_directory})
+        self.config.include('pyramid_chameleon')
+        self.config.include('pyramid_layout')
+        self.config.add_static_view('static', 'submit:static')
+        add_routes(self.config)
+        self.config.scan('submit.layout')
+        self.config.scan('submit.panels')
+
+    def tearDown(self):
+        Session.remove()
+        testing.tearDown()
+        shutil.rmtree(self.file_directory)
+
+    def seed(self, groups, testables, test_cases):
+        """Return the ids of an admin and of a submission with results."""
+        class_ = Class(name='CS 101')
+        project = Project(name='Project 1', class_=class_)
+        admin = User(name='Admin', username='admin', password='password',
+                     is_admin=True)
+        class_.admins.append(admin)
+        expected = File.fetch_or_create('expected\n', self.file_directory)
+        diff = File.fetch_or_create('diff\n', self.file_directory)
+        submissions = []
+        for i in range(groups):
+            user = User(name='Student {}'.format(i),
+                        username='student{}'.format(i), password='password')
+            class_.users.append(user)
+            group = Group(project=project)
+            Session.add(UserToGroup(group=group, project=project, user=user))
+            for _ in range(2):
+                submissions.append(Submission(
+                    created_by=user, group=group, project=project,
+                    verification_results=VerificationResults()))
+        submission = submissions[len(submissions) // 2]
+        for i in range(testables):
+            testable = Testable(name='Testable {}'.format(i),
+                                executable='a.out', is_hidden=bool(i % 2),
+                                project=project)
+            Session.add(TestableResult(points=test_cases, status='success',
+                                       submission=submission,
+                                       testable=testable))
+            for j in range(test_cases):
+                test_case = TestCase(name='Test case {}'.format(j), args='',
+                                     expected=expected, points=1,
+                                     testable=testable)
+                Session.add(TestCaseResult(
+                    diff=diff if j % 2 else None, diff_first_line=1,
+                    diff_issue='mismatch', diff_lines=1, status='success',
+                    submission=submission, test_case=test_case))
+        Session.add(class_)
+        Session.flush()
+        submission.update_scores()
+        ids = admin.id, submission.id
+        transaction.commit()
+        Session.remove()
+        return ids
+
+    def count_view_queries(self, groups, testables, test_cases):
+        """Return the queries of viewing a submission seeded into a new
+        database as an admin.
+
+        """
+        Session.remove()
+        engine = create_engine('sqlite://')
+        configure_sql(engine)
+        create_schema()
+        count_queries(engine)
+        admin_id, submission_id = self.seed(groups, testables, test_cases)
+        request = testing.DummyRequest(
+            matchdict={'submission_id': str(submission_id)},
+            matched_route=self.config.get_routes_mapper().get_route(
+                'submission_item'))
+        apply_request_extensions(request)
+        self.config.begin(request)
+        request.user = User.fetch_by(id=admin_id)
+        request.query_stats = QueryStats()
+        info = submission_view(request)
+        self.assertTrue(info['submission_admin'])
+        self.assertTrue(info['diff_table'])
+        render('submit:templates/submission_view.pt', info, request)
+        return request.query_stats.count
+
+    def test_queries_do_not_grow_with_submission(self):
+        small = self.count_view_queries(2, 2, 2)
+        self.assertLessEqual(small, self.BUDGET)
+        self.assertEqual(small, self.count_view_queries(20, 10, 20))
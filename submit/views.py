@@ -19,7 +19,7 @@ from pyramid.settings import asbool
 from pyramid.view import (forbidden_view_config, notfound_view_config,
                           view_config)
 from sqlalchemy.exc import IntegrityError
-from .diff_render import HTMLDiff
+from .diff_render import MAX_NUM_REVEALS, HTMLDiff
 from .exceptions import GroupWithException, InvalidId
 from .helpers import (
     AccessibleDBThing, DBThing as AnyDBThing, DummyTemplateAttr,
@@ -30,8 +30,8 @@ from .helpers import (
     test_case_verification, zip_response)
 from .models import (BuildFile, Class, ExecutionFile, File, FileVerifier,
                      Group, GroupRequest, PasswordReset, Project, Session,
-                     Submission, SubmissionToFile, TestCase, Testable, User,
-                     UserToGroup)
+                     Submission, SubmissionToFile, TestCase, TestCaseResult,
+                     Testable, User, UserToGroup)
 
 # Hack for old pickle files
 # TODO: Migrate this data to not use pickle
@@ -42,6 +42,9 @@ sys.modules['nudibranch.diff_unit'] = submit.diff_unit
 sys.modules['nudibranch.models'] = submit.models
 
 # A few reoccuring validators
+COMPARISON = Enum('comparison', 'exact', 'case', 'numeric',
+                  'trailing_whitespace', 'whitespace', optional=True)
+DIFF_ENGINE = Enum('diff_engine', 'dmp', 'fast')
 OUTPUT_SOURCE = Enum('output_source', 'stdout', 'stderr', 'file')
 OUTPUT_TYPE = Enum('output_type', 'diff', 'image', 'text')
 SHA1_VALIDATOR = String('sha1sum', min_length=40, max_length=40,
@@ -758,16 +761,17 @@ def project_test_case_generate(request, submission):
                               optional=True),
           deadline=TextDate('deadline', optional=True),
           delay_minutes=TextNumber('delay_minutes', min_value=1),
+          diff_engine=DIFF_ENGINE,
           group_max=TextNumber('group_max', min_value=1),
           project=EditableDBThing('project_id', Project, source=MATCHDICT))
 def project_update(request, name, makefile, is_ready, deadline, delay_minutes,
-                   group_max, project):
+                   diff_engine, group_max, project):
     # Fix timezone if it doesn't exist
     if project.deadline and deadline and not deadline.tzinfo:
         deadline = deadline.replace(tzinfo=project.deadline.tzinfo)
     if not project.update(name=name, makefile=makefile, deadline=deadline,
                           delay_minutes=delay_minutes,
-                          group_max=group_max,
+                          diff_engine=diff_engine, group_max=group_max,
                           status=u'ready' if bool(is_ready) else u'notready'):
         return http_ok(request, message='Nothing to change')
     try:
@@ -887,6 +891,13 @@ def project_view_summary(request, project):
             'submissions': sorted(submissions.items())}
 
 
+@view_config(route_name='query_stats', request_method='GET', renderer='json',
+             permission='admin')
+def query_stats(request):
+    """Return the query and time percentiles of this process's routes."""
+    return request.registry.route_stats.percentiles()
+
+
 @view_config(route_name='session', request_method='PUT', renderer='json')
 @validate(username=Or('email', EmailAddress(''), String('')),
           password=WhiteSpaceString('password', min_length=6),
@@ -997,6 +1008,55 @@ def submission_requeue(request, submission):
     return http_ok(request, redir_location=request.url)
 
 
+@view_config(route_name='submission_item_diff', request_method='GET',
+             renderer='json', permission='authenticated')
+@validate(submission=ViewableDBThing('submission_id', Submission,
+                                     source=MATCHDICT),
+          test_case=AnyDBThing('test_case_id', TestCase, source=MATCHDICT),
+          page=TextNumber('page', min_value=0, source=SOURCE_GET),
+          as_user=TextNumber('as_user', min_value=0, max_value=1,
+                             optional=True, source=SOURCE_GET))
+def submission_diff_page(request, submission, test_case, page, as_user):
+    """Return the html table of a single page of a test case's diff."""
+    submission_admin = not bool(as_user) and \
+        submission.project.can_edit(request.user)
+    if not submission_admin and (test_case.testable.is_hidden or
+                                 submission.get_delay(update=False)):
+        raise HTTPNotFound()
+    tcr = TestCaseResult.fetch_by_ids(submission.id, test_case.id)
+    if not tcr or not tcr.diff:
+        raise HTTPNotFound()
+    # The table's links depend upon the submission and as_user
+    cache = request.registry.render_cache
+    key = cache.key(tcr.diff.sha1, page, submission_admin,
+                    test_case.hide_expected, test_case.id, submission.id,
+                    bool(as_user))
+
+    def render():
+        renderable = prepare_renderable(request, tcr, submission_admin)
+        if not renderable.show_diff_table():
+            raise HTTPNotFound()
+        diff_renderer = HTMLDiff(
+            num_reveal_limit=None if submission_admin else MAX_NUM_REVEALS,
+            page_url=diff_page_url(request, submission, as_user),
+            prefix=str('{}p{}'.format(test_case.id, page)))
+        return diff_renderer.make_table(renderable, page)
+    table = cache.get_or_render(key, render)
+    return {'html': table.decode('utf-8', 'ignore')}
+
+
+def diff_page_url(request, submission, as_user):
+    """Return a function building the url of a page of a diff."""
+    query = {'as_user': 1} if as_user else {}
+
+    def page_url(renderable, page):
+        return request.route_path('submission_item_diff',
+                                  submission_id=submission.id,
+                                  test_case_id=renderable.number,
+                                  _query=dict(query, page=page))
+    return page_url
+
+
 @view_config(route_name='submission_item', request_method='GET',
              renderer='templates/submission_view.pt',
              permission='authenticated')
@@ -1005,6 +1065,7 @@ def submission_requeue(request, submission):
           as_user=TextNumber('as_user', min_value=0, max_value=1,
                              optional=True, source=SOURCE_GET))
 def submission_view(request, submission, as_user):
+    submission = Submission.fetch_for_view(submission.id)
     actual_admin = submission.project.can_edit(request.user)
     submission_admin = not bool(as_user) and actual_admin
     if not submission_admin:  # Only check delay for user view
@@ -1023,16 +1084,19 @@ def submission_view(request, submission, as_user):
 
     points_possible = submission.project.points_possible(
         include_hidden=submission_admin)
+    page_url = diff_page_url(request, submission, as_user)
     if submission_admin:
         diff_renderer = HTMLDiff(num_reveal_limit=None,
-                                 points_possible=points_possible)
+                                 points_possible=points_possible,
+                                 page_url=page_url)
     else:
-        diff_renderer = HTMLDiff(points_possible=points_possible)
+        diff_renderer = HTMLDiff(points_possible=points_possible,
+                                 page_url=page_url)
 
     for tcr in submission.test_case_results:
         if submission_admin or not tcr.test_case.testable.is_hidden:
-            diff_renderer.add_renderable(prepare_renderable(request, tcr,
-                                                            submission_admin))
+            diff_renderer.add_renderable(prepare_renderable(
+                request, tcr, submission_admin, summary_only=True))
     if submission.verification_results:
         mapping = submission.file_mapping()
         extra_files = {x: mapping[x] for x in
@@ -1088,7 +1152,7 @@ def submission_view(request, submission, as_user):
 @view_config(route_name='test_case', request_method='PUT',
              permission='authenticated', renderer='json')
 @validate(name=String('name', min_length=1),
-          args=String('args', min_length=1),
+          args=String('args', min_length=1), comparison=COMPARISON,
           expected=ViewableDBThing('expected_id', File, optional=True),
           hide_expected=TextNumber('hide_expected', min_value=0, max_value=1,
                                    optional=True),
@@ -1099,10 +1163,11 @@ def submission_view(request, submission, as_user):
           stdin=ViewableDBThing('stdin_id', File, optional=True),
           testable=EditableDBThing('testable_id', Testable))
 @test_case_verification
-def test_case_create(request, name, args, expected, hide_expected,
-                     output_filename, output_source, output_type, points,
-                     stdin, testable):
-    test_case = TestCase(name=name, args=args, expected=expected,
+def test_case_create(request, name, args, comparison, expected,
+                     hide_expected, output_filename, output_source,
+                     output_type, points, stdin, testable):
+    test_case = TestCase(name=name, args=args,
+                         comparison=comparison or 'exact', expected=expected,
                          hide_expected=bool(hide_expected),
                          output_filename=output_filename,
                          output_type=output_type, points=points,
@@ -1136,7 +1201,7 @@ def test_case_delete(request, test_case):
 @view_config(route_name='test_case_item', request_method='POST',
              permission='authenticated', renderer='json')
 @validate(name=String('name', min_length=1),
-          args=String('args', min_length=1),
+          args=String('args', min_length=1), comparison=COMPARISON,
           expected=ViewableDBThing('expected_id', File, optional=True),
           hide_expected=TextNumber('hide_expected', min_value=0, max_value=1,
                                    optional=True),
@@ -1148,10 +1213,12 @@ def test_case_delete(request, test_case):
           test_case=EditableDBThing('test_case_id', TestCase,
                                     source=MATCHDICT))
 @test_case_verification
-def test_case_update(request, name, args, expected, hide_expected,
-                     output_filename, output_source, output_type, points,
-                     stdin, test_case):
-    if not test_case.update(name=name, args=args, expected=expected,
+def test_case_update(request, name, args, comparison, expected,
+                     hide_expected, output_filename, output_source,
+                     output_type, points, stdin, test_case):
+    if not test_case.update(name=name, args=args,
+                            comparison=comparison or test_case.comparison,
+                            expected=expected,
                             hide_expected=bool(hide_expected),
                             output_filename=output_filename,
                             output_type=output_type, points=points,
@@ -1216,6 +1283,7 @@ def testable_create(request, name, is_hidden, make_target, executable,
         Session.flush()
     except IntegrityError:
         raise HTTPConflict('That name already exists for the project')
+    project.update_scores()  # The testable is pending for each submission
     return http_created(request, redir_location=redir_location,
                         testable_id=testable.id)
 
@@ -1266,6 +1334,7 @@ def testable_edit(request, name, is_hidden, make_target, executable,
         Session.flush()
     except IntegrityError:
         raise HTTPConflict('That name already exists for the project')
+    testable.project.update_scores()
     request.session.flash('Updated Testable {0}.'.format(testable.name),
                           'successes')
     redir_location = request.route_path('project_edit',
@@ -1281,7 +1350,10 @@ def testable_delete(request, testable):
                                         project_id=testable.project.id)
     request.session.flash('Deleted Testable {0}.'.format(testable.name),
                           'successes')
+    project = testable.project
     Session.delete(testable)
+    Session.flush()
+    project.update_scores()
     return http_ok(request, redir_location=redir_location)
 
 
@@ -1,6 +1,8 @@
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
+import json
 import os
+import pika
 import shutil
 import tempfile
 import transaction
@@ -12,13 +14,37 @@ def log_msg(msg):
     print('{} {}'.format(datetime.now(), msg))
 
 
-def wrapper(func):
+def publish(server, queue, **kwargs):
+    """Send the keyword arguments as a persistent message to queue."""
+    conn = pika.BlockingConnection(pika.ConnectionParameters(host=server))
+    try:
+        conn.channel().basic_publish(
+            exchange='', body=json.dumps(kwargs), routing_key=queue,
+            properties=pika.BasicProperties(delivery_mode=2))
+    finally:
+        conn.close()
+
+
+def wrapper(func=None, chdir=True):
+    """Run func in a temporary directory and commit its transaction.
+
+    When chdir is False the process-wide working directory is left alone and
+    the temporary directory is instead passed to func as `work_dir`, which
+    makes the wrapper safe to use from multiple threads.
+
+    """
+    if func is None:
+        return partial(wrapper, chdir=chdir)
+
     @wraps(func)
     def wrapped(*args, **kwargs):
         # Create temporary directory
         prev_cwd = os.getcwd()
         new_cwd = tempfile.mkdtemp()
-        os.chdir(new_cwd)
+        if chdir:
+            os.chdir(new_cwd)
+        else:
+            kwargs['work_dir'] = new_cwd
         try:
             retval = func(*args, **kwargs)
             transaction.commit()
@@ -28,6 +54,7 @@ def wrapper(func):
         finally:
             # Remove temporary directory
             shutil.rmtree(new_cwd)
-            os.chdir(prev_cwd)
+            if chdir:
+                os.chdir(prev_cwd)
         return retval
     return wrapped
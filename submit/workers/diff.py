@@ -0,0 +1,88 @@
+import amqp_worker
+import hashlib
+import multiprocessing
+from sqlalchemy import engine_from_config
+from .. import workers
+from ..diff_render import MAX_NUM_REVEALS
+from ..diff_unit import CompactDiff
+from ..models import File, TestCaseResult, configure_sql
+
+# Students see no further than the hunk revealing more than MAX_NUM_REVEALS
+# expected lines so the diff stops there until an admin views it in full
+MAX_HUNKS = MAX_NUM_REVEALS + 1
+POOL = None
+POOL_SIZE = None
+
+
+def compute_diff(args):
+    """Return the saved diff and its summary, or None when outputs match.
+
+    This runs in the pool's processes thus it is only given file paths.
+
+    """
+    base_file_path, expected_sha1, output_sha1, engine = args
+    with open(File.file_path(base_file_path, expected_sha1)) as fp:
+        expected_output = fp.read()
+    with open(File.file_path(base_file_path, output_sha1)) as fp:
+        actual_output = fp.read()
+    unit = CompactDiff(expected_output, actual_output, expected_sha1, engine,
+                       MAX_HUNKS)
+    if unit.outputs_match():
+        return None
+    return unit.dumps(), unit.summary()
+
+
+@workers.wrapper
+def do_work(submission_id, outputs):
+    """Diff the pending outputs of a submission's test case results.
+
+    `outputs` is a list of (test case id, output sha1) pairs. A result whose
+    output has since changed belongs to a later run and is skipped.
+
+    """
+    global POOL
+    if POOL is None:  # Created in the (possibly daemonized) worker process
+        POOL = multiprocessing.Pool(POOL_SIZE)
+    outputs = dict(outputs)
+    existing = TestCaseResult.fetch_by_submission(submission_id, list(outputs))
+    pending = [x for x in existing.values()
+               if x.output and x.output.sha1 == outputs[x.test_case_id]]
+    diffs = POOL.map(compute_diff, [
+        (workers.BASE_FILE_PATH, x.test_case.expected.sha1, x.output.sha1,
+         x.test_case.testable.project.diff_engine) for x in pending])
+    files = File.fetch_or_create_many([x[0] for x in diffs if x],
+                                      workers.BASE_FILE_PATH)
+    for test_case_result, diff in zip(pending, diffs):
+        test_case_result.output = None
+        if diff:  # Always, as the output's sha1 differs from the expected
+            data, summary = diff
+            test_case_result.diff = files[hashlib.sha1(data).hexdigest()]
+            (test_case_result.diff_issue, test_case_result.diff_lines,
+             test_case_result.diff_first_line,
+             test_case_result.diff_partial) = summary
+    workers.log_msg('{}: diffed {} of {} outputs'.format(
+        submission_id, len(pending), len(outputs)))
+
+
+def main():
+    global POOL_SIZE
+    parser = amqp_worker.base_argument_parser()
+    parser.add_argument('--processes', type=int,
+                        help=('number of diffs to compute at once (default: '
+                              'the number of cores)'))
+    args, settings = amqp_worker.parse_base_args(parser, 'app:main')
+    workers.BASE_FILE_PATH = settings['file_directory']
+    POOL_SIZE = args.processes
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    configure_sql(engine)
+
+    worker = amqp_worker.AMQPWorker(
+        settings['queue_server'], settings['queue_diff'], do_work,
+        is_daemon=args.daemon, error_queue=settings.get('queue_diff_error'),
+        log_file=settings['diff_worker_log_file'],
+        pid_file=settings['diff_worker_pid_file'],
+        email_subject='Diff Worker Exception',
+        email_from=settings['exc_mail_from'], email_to=settings['exc_mail_to'])
+
+    worker.handle_command(args.command)
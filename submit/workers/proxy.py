@@ -1,75 +1,112 @@
 import amqp_worker
+import hashlib
+import itertools
 import json
 import os
-import pickle
-import random
+import pipes
 import subprocess
+import tempfile
+import threading
 import time
-from heapq import heappop, heappush
+import traceback
+import transaction
 from sqlalchemy import engine_from_config
 from .exceptions import HandledError, SSHConnectTimeout
+from .scheduler import MachineScheduler
+from .worker import CORRUPT_BLOB_STATUS
 from .. import workers
-from ..diff_unit import Diff
+from ..diff_unit import outputs_equivalent
 from ..models import (File, Session, Submission, TestCaseResult, Testable,
                       TestableResult, configure_sql)
 
+# Seconds an idle control master connection is kept open
+CONTROL_PERSIST = 600
 
-def set_expected_files(testable, results, base_file_path):
+# Kill every process owned by the worker account except for this shell and
+# its ancestors, among them the sshd process backing the control master
+# connection, then output the 1 minute load average and the number of cores.
+# The processes are spared by pid as any program can take the name of sshd.
+KILL_COMMAND = ('keep=" $$ "; pid=$$; while [ "$pid" -gt 1 ]; do '
+                'pid=$(ps -o ppid= -p $pid | tr -d " "); '
+                '[ -z "$pid" ] && break; keep="$keep$pid "; done; '
+                'for pid in $(ps -u {0} -o pid=); do case "$keep" in '
+                '*" $pid "*) ;; *) kill -9 $pid 2>/dev/null;; esac; done; '
+                'echo $(cut -d" " -f1 /proc/loadavg) $(nproc); true')
+
+
+def set_expected_files(testable, results, base_file_path, results_dir):
     # Update the expected output of each test case
+    outputs = []  # (TestCase, expected output) pairs
     for test_case in testable.test_cases:
         if test_case.id not in results:
             raise Exception('Missing test case result in project update: {0}'
                             .format(test_case.id))
         if test_case.output_type == 'diff':
-            output_file = 'tc_{0}'.format(test_case.id)
-            test_case.expected = File.fetch_or_create(
-                open(output_file).read(), base_file_path)
+            output_file = os.path.join(results_dir,
+                                       'tc_{0}'.format(test_case.id))
+            with open(output_file) as fp:
+                outputs.append((test_case, fp.read()))
+    files = File.fetch_or_create_many([x[1] for x in outputs], base_file_path)
+    for test_case, data in outputs:
+        test_case.expected = files[hashlib.sha1(data).hexdigest()]
     testable.is_locked = False
     if not any(x.is_locked for x in testable.project.testables):
         testable.project.status = u'notready'
 
 
-def compute_diff(test_case, test_case_result, output_file, base_file_path):
-    """Associate the diff (if exists) with the TestCaseResult.
-
-    Return whether or not the outputs match.
-
-    """
-    with open(File.file_path(base_file_path, test_case.expected.sha1)) as fp:
-        expected_output = fp.read()
-    actual_output = ''
-    if os.path.isfile(output_file):
-        with open('tc_{0}'.format(test_case.id)) as fp:
-            actual_output = fp.read()
-    unit = Diff(expected_output, actual_output)
-    if not unit.outputs_match():
-        test_case_result.diff = File.fetch_or_create(pickle.dumps(unit),
-                                                     base_file_path)
-        return False
-    return True
+def job_key(submission_id, testable_ids):
+    return '{}.{}'.format(submission_id,
+                          ','.join(str(x) for x in testable_ids))
 
 
 class WorkerProxy():
     def __init__(self):
         parser = amqp_worker.base_argument_parser()
         parser.add_argument('worker_account', type=str)
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='number of jobs to run at once (default: 1)')
+        parser.add_argument('--test-concurrency', type=int,
+                            help=('number of test cases each worker runs at '
+                                  'once (default: its number of cores)'))
         args, settings = amqp_worker.parse_base_args(parser, 'app:main')
 
         self.base_file_path = settings['file_directory']
         self.private_key_file = settings['ssh_priv_key']
+        self.queue_diff = settings['queue_diff']
+        self.queue_server = settings['queue_server']
         self.account = args.worker_account
+        self.test_concurrency = args.test_concurrency
+        self.control_path = os.path.join(
+            settings.get('ssh_control_dir', tempfile.gettempdir()),
+            'submit-%r@%h:%p')
         machines = settings['worker_machines']
         if isinstance(machines, basestring):
             machines = [machines]
-        random.shuffle(machines)
-        self.machines = [(5., x) for x in machines]
+        # Each machine runs at most one job at a time for this worker account
+        self.scheduler = MachineScheduler(
+            machines, scoreboard_file=settings.get(
+                'worker_proxy_scoreboard_file', '').format(self.account))
+        concurrency = min(args.concurrency, len(machines))
+        self.slots = (threading.BoundedSemaphore(concurrency)
+                      if concurrency > 1 else None)
+        self.results_lock = threading.Lock()
+        # Jobs handed to threads are journaled until they finish so that those
+        # lost to a crash or restart are queued again
+        self.error_queue = settings.get('queue_tell_worker_error')
+        self.jobs = {}  # Maps a number unique to each job to its message
+        self.jobs_counter = itertools.count()
+        self.jobs_file = settings.get('worker_proxy_jobs_file', '').format(
+            self.account)
+        self.jobs_lock = threading.Lock()
+        self.jobs_recovered = False
+        self.queue_tell_worker = settings['queue_tell_worker']
         engine = engine_from_config(settings, 'sqlalchemy.')
         configure_sql(engine)
 
         worker = amqp_worker.AMQPWorker(
             settings['queue_server'], settings['queue_tell_worker'],
             self.do_work, is_daemon=args.daemon,
-            error_queue=settings.get('queue_tell_worker_error'),
+            error_queue=self.error_queue,
             log_file=settings['worker_proxy_log_file'].format(self.account),
             pid_file=settings['worker_proxy_pid_file'].format(self.account),
             email_subject='WorkerProxy {} Exception'.format(self.account),
@@ -78,215 +115,473 @@ class WorkerProxy():
 
         worker.handle_command(args.command)
 
-    @workers.wrapper
-    def do_work(self, submission_id, testable_id, update_project=False):
+    def do_work(self, submission_id, testable_id=None, update_project=False,
+                testable_ids=None):
+        """Run the job, or hand it off to a free thread in concurrent mode.
+
+        A job covers all of `testable_ids`, which are built and run by a
+        single invocation of the remote worker. `testable_id` is accepted
+        for messages queued before jobs were batched.
+
+        In concurrent mode this call only blocks while every thread is busy,
+        thus the message is acknowledged once the job starts. The job is
+        journaled until it finishes and, should it fail, is sent to the
+        error queue as the serial mode does. Jobs journaled by a previous
+        run of the proxy, which never finished, are queued again upon the
+        first message.
+
+        """
+        if not testable_ids:
+            testable_ids = [testable_id]
+        if not self.slots:
+            return self.run_job(submission_id, testable_ids, update_project)
+        if not self.jobs_recovered:
+            self.requeue_jobs()
+        message = {'submission_id': submission_id,
+                   'testable_ids': testable_ids,
+                   'update_project': update_project}
+        self.slots.acquire()
+        number = next(self.jobs_counter)
+        self.journal_job(number, message)
+        thread = threading.Thread(
+            target=self.run_job_thread, args=(number, message),
+            name=job_key(submission_id, testable_ids))
+        thread.start()
+
+    def journal_job(self, number, message=None):
+        """Add the message of job `number` to the journal, or remove it."""
+        with self.jobs_lock:
+            if message:
+                self.jobs[number] = message
+            else:
+                del self.jobs[number]
+            if not self.jobs_file:
+                return
+            tmp_file = '{}.tmp'.format(self.jobs_file)
+            with open(tmp_file, 'w') as fp:
+                json.dump(self.jobs.values(), fp)
+            os.rename(tmp_file, self.jobs_file)
+
+    def requeue_jobs(self):
+        """Queue again the jobs a previous run of the proxy left unfinished."""
+        self.jobs_recovered = True
+        if not self.jobs_file or not os.path.isfile(self.jobs_file):
+            return
+        with open(self.jobs_file) as fp:
+            messages = json.load(fp)
+        for message in messages:
+            workers.publish(self.queue_server, self.queue_tell_worker,
+                            **message)
+            workers.log_msg('{} requeued'.format(job_key(
+                message['submission_id'], message['testable_ids'])))
+        os.unlink(self.jobs_file)
+
+    def run_job_thread(self, number, message):
+        key = job_key(message['submission_id'], message['testable_ids'])
+        try:
+            self.run_job(message['submission_id'], message['testable_ids'],
+                         message['update_project'])
+        except Exception:
+            workers.log_msg('{} failed\n{}'.format(key,
+                                                   traceback.format_exc()))
+            if self.error_queue:
+                try:
+                    workers.publish(self.queue_server, self.error_queue,
+                                    **message)
+                except Exception:
+                    workers.log_msg('{} could not be sent to {}\n{}'.format(
+                        key, self.error_queue, traceback.format_exc()))
+        finally:
+            self.journal_job(number)
+            Session.remove()
+            self.slots.release()
+
+    @workers.wrapper(chdir=False)
+    def run_job(self, submission_id, testable_ids, update_project=False,
+                work_dir=None):
         # Verify job
         submission = Submission.fetch_by_id(submission_id)
         if not submission:
             raise HandledError('Invalid submission id: {0}'
                                .format(submission_id))
-        testable = Testable.fetch_by_id(testable_id)
-        if not testable:
-            raise HandledError('Invalid testable id: {0}'.format(testable_id))
         if update_project and submission.project.status != u'locked':
             raise HandledError('Rejecting update to unlocked project: {0}'
                                .format(submission.project.id))
-        if update_project and not testable.is_locked:
-            raise HandledError('Rejecting update to unlocked testable: {0}'
-                               .format(testable_id))
+        testables = []
+        for testable_id in testable_ids:
+            testable = Testable.fetch_by_id(testable_id)
+            if not testable:
+                raise HandledError('Invalid testable id: {0}'
+                                   .format(testable_id))
+            if update_project and not testable.is_locked:
+                raise HandledError('Rejecting update to unlocked testable: {0}'
+                                   .format(testable_id))
+            testables.append(testable)
+        key = job_key(submission_id, testable_ids)
 
         attempt = 0
         while attempt < 16:
             # Fetch the best machine
-            priority, machine = heappop(self.machines)
+            machine = self.scheduler.acquire()
             # Log the start of the job
-            workers.log_msg('{}.{} begin ({})'
-                            .format(submission_id, testable_id, machine))
+            workers.log_msg('{} begin ({})'.format(key, machine))
             log_type = 'unhandled'
+            timing = []
+            failed = True
+            penalty = 0
+            load = None
             try:
+                # Ensure there is a healthy control master to the worker
+                start = time.time()
+                self.connect(machine)
+                timing.append(('connect', time.time() - start))
                 # Kill any processes on the worker
-                priority = self.kill_processes(machine)
+                start = time.time()
+                load = self.kill_processes(machine)
+                timing.append(('kill', time.time() - start))
                 # Copy the files to the worker (and remove existing files)
-                self.push_files(machine, submission, testable)
+                start = time.time()
+                self.push_files(machine, submission, testables, work_dir)
+                timing.append(('push', time.time() - start))
                 # Run the remote worker
+                start = time.time()
                 self.ssh(machine, 'python worker.py')
+                timing.append(('execute', time.time() - start))
                 # Fetch and generate the results
-                self.fetch_results(machine, submission, testable,
-                                   update_project)
+                start = time.time()
+                self.rsync(machine, os.path.join(work_dir, 'results'),
+                           remote='working/results/')
+                pending = []
+                with self.results_lock:
+                    for testable in testables:
+                        pending.extend(self.fetch_results(
+                            work_dir, submission, testable, update_project))
+                    # Commit while holding the lock so that concurrent jobs
+                    # cannot race to create the same File rows
+                    transaction.commit()
+                timing.append(('fetch', time.time() - start))
+                if pending:
+                    self.queue_diffs(submission_id, pending)
                 log_type = 'success'
+                failed = False
                 return
             except SSHConnectTimeout:  # Retry with a different host
                 attempt += 1
                 log_type = 'timeout'
-                priority += 10
-            except Exception:  # Increase priority and rereaise the exception
+                penalty = 10
+            except subprocess.CalledProcessError as exc:
+                if exc.returncode != CORRUPT_BLOB_STATUS:
+                    log_type = 'exception'
+                    penalty = 5
+                    raise
+                # The worker removed the corrupt blobs thus retrying the job
+                # pushes them again
+                attempt += 1
+                log_type = 'corrupt_blob'
+                failed = None
+            except HandledError:  # The job, not the machine, is at fault
+                log_type = 'exception'
+                failed = None
+                raise
+            except Exception:  # Penalize the machine and reraise
                 log_type = 'exception'
-                priority += 5
+                penalty = 5
                 raise
             finally:
-                # Add the machine back to the queue
-                heappush(self.machines, (priority, machine))
+                # Return the machine to the scheduler
+                job_time = None if failed is not False else \
+                    sum(x[1] for x in timing)
+                stats = self.scheduler.release(machine, job_time, failed,
+                                               penalty, load)
                 # Log the end of the job
-                workers.log_msg('{}.{} {} ({})'.format(submission_id,
-                                                       testable_id, log_type,
-                                                       machine))
-        raise Exception('{}.{} timed out 16 times.'
-                        .format(submission_id, testable_id))
+                workers.log_msg('{} {} ({}) {} score={score:.3f}'.format(
+                    key, log_type, machine,
+                    ' '.join('{}={:.3f}s'.format(*x) for x in timing),
+                    **stats))
+        raise Exception('{} timed out 16 times.'.format(key))
 
-    def fetch_results(self, machine, submission, testable, update_project):
-        # Rsync to retrieve results
-        self.rsync(machine)
-        os.chdir('results')
+    def fetch_results(self, work_dir, submission, testable, update_project):
+        """Store the results of the testable.
+
+        The outputs of `diff` test cases that match their expected output,
+        according to the test case's comparison, are awarded points right
+        away. The rest are stored as the results'
+        output, and a list of their (test case id, output sha1) pairs is
+        returned for the diff worker.
+
+        """
+        results_dir = os.path.join(work_dir, 'results', str(testable.id))
 
         # Create dictionary of completed test_cases
-        if os.path.isfile('test_cases'):
-            with open('test_cases') as fp:
+        test_cases_file = os.path.join(results_dir, 'test_cases')
+        if os.path.isfile(test_cases_file):
+            with open(test_cases_file) as fp:
                 results = {int(x[0]): x[1] for x in json.load(fp).items()}
         else:
             results = {}
 
+        # Per test case timing is only logged
+        timing = [x.pop('timing', None) or {} for x in results.values()]
+        if timing:
+            workers.log_msg('{}.{} test cases setup={:.3f}s run={:.3f}s'
+                            .format(submission.id, testable.id,
+                                    sum(x.get('setup', 0) for x in timing),
+                                    sum(x.get('run', 0) for x in timing)))
+
         if update_project:
-            set_expected_files(testable, results, self.base_file_path)
-            return
+            set_expected_files(testable, results, self.base_file_path,
+                               results_dir)
+            return []
 
         points = 0
 
-        # Set or update relevant test case results
+        # Set or update relevant test case results using a single query to
+        # fetch the existing results and a single flush to create new Files
+        existing = TestCaseResult.fetch_by_submission(
+            submission.id, [x.id for x in testable.test_cases])
+        diffs = []  # (TestCaseResult, diff file data) pairs
+        outputs = []  # (TestCaseResult, output to diff) pairs
         for test_case in testable.test_cases:
-            test_case_result = TestCaseResult.fetch_by_ids(submission.id,
-                                                           test_case.id)
+            test_case_result = existing.get(test_case.id)
             if test_case.id not in results:
                 if test_case_result:  # Delete existing result
                     Session.delete(test_case_result)
+                continue
+            if test_case_result:
+                test_case_result.update(results[test_case.id])
             else:
-                if test_case_result:
-                    test_case_result.update(results[test_case.id])
-                else:
-                    results[test_case.id]['submission_id'] = submission.id
-                    results[test_case.id]['test_case_id'] = test_case.id
-                    test_case_result = TestCaseResult(**results[test_case.id])
-                    Session.add(test_case_result)
-                output_file = 'tc_{0}'.format(test_case.id)
-                if test_case.output_type == 'diff':
-                    matches = compute_diff(test_case, test_case_result,
-                                           output_file, self.base_file_path)
-                    if matches and test_case_result.status == 'success':
+                results[test_case.id]['submission_id'] = submission.id
+                results[test_case.id]['test_case_id'] = test_case.id
+                test_case_result = TestCaseResult(**results[test_case.id])
+                Session.add(test_case_result)
+            output_file = os.path.join(results_dir,
+                                       'tc_{0}'.format(test_case.id))
+            if test_case.output_type == 'diff':
+                # Clear any diff from a previous run
+                test_case_result.diff = None
+                test_case_result.diff_issue = None
+                test_case_result.diff_lines = None
+                test_case_result.diff_first_line = None
+                test_case_result.diff_partial = False
+                output = ''
+                if os.path.isfile(output_file):
+                    with open(output_file) as fp:
+                        output = fp.read()
+                if hashlib.sha1(output).hexdigest() == \
+                        test_case.expected.sha1 or \
+                        test_case.comparison != 'exact' and \
+                        self.outputs_equivalent(test_case, output_file):
+                    test_case_result.output = None
+                    if test_case_result.status == 'success':
                         points += test_case.points
-                else:
-                    if os.path.isfile(output_file):  # Store file as the diff
-                        test_case_result.diff = File.fetch_or_create(
-                            open(output_file).read(), self.base_file_path)
-
-        # Create or update Testable
-        testable_data = json.load(open('testable'))
+                else:  # The diff worker computes the diff
+                    outputs.append((test_case_result, output))
+            elif os.path.isfile(output_file):  # Store file as the diff
+                with open(output_file) as fp:
+                    diffs.append((test_case_result, fp.read()))
+        files = File.fetch_or_create_many([x[1] for x in diffs + outputs],
+                                          self.base_file_path)
+        for test_case_result, data in diffs:
+            test_case_result.diff = files[hashlib.sha1(data).hexdigest()]
+        for test_case_result, data in outputs:
+            test_case_result.output = files[hashlib.sha1(data).hexdigest()]
+
+        # Create or update Testable and the submission's scores
+        testable_data = json.load(open(os.path.join(results_dir, 'testable')))
+        previous = TestableResult.fetch_by(testable=testable,
+                                           submission=submission)
+        previous_points = previous.points if previous else None
         TestableResult.fetch_or_create(
             make_results=testable_data.get('make'), points=points,
             status=testable_data['status'], testable=testable,
             submission=submission)
+        submission.record_testable_result(testable, points, previous_points)
+        return [(x.test_case_id, x.output.sha1) for x, _ in outputs]
+
+    def connect(self, machine):
+        """Start the control master for machine unless one is running.
+
+        All other ssh and rsync invocations are multiplexed over the control
+        master so that they do not each pay for a new connection.
+
+        """
+        try:
+            self.ssh(machine, options='-O check')
+            return
+        except subprocess.CalledProcessError:
+            pass
+        # The previous master (if any) is unresponsive so start a new one
+        self.ssh(machine, timeout=1, options='-fNM -o ControlPersist={}'
+                 .format(CONTROL_PERSIST))
+
+    def queue_diffs(self, submission_id, outputs, attempts=3):
+        """Ask the diff worker to diff the submission's pending outputs.
+
+        The results are already committed, thus should every attempt fail the
+        outputs stay pending until scripts/requeue_diffs.py queues them.
+
+        """
+        for attempt in range(1, attempts + 1):
+            try:
+                workers.publish(self.queue_server, self.queue_diff,
+                                submission_id=submission_id, outputs=outputs)
+                return
+            except Exception:
+                workers.log_msg('{} could not queue diffs (attempt {})\n{}'
+                                .format(submission_id, attempt,
+                                        traceback.format_exc()))
+                if attempt < attempts:
+                    time.sleep(attempt)
 
     def kill_processes(self, machine):
-        expected = 'Connection to {} closed by remote host.'.format(machine)
-        start = time.time()
+        """Kill the account's processes and return the per-core load."""
+        output = self.ssh(machine,
+                          pipes.quote(KILL_COMMAND.format(self.account)))
         try:
-            self.ssh(machine, 'killall -9 -u {}'.format(self.account),
-                     timeout=1)
-            raise Exception('killall did not work as expected')
-        except subprocess.CalledProcessError as exc:
-            if exc.returncode != 255 or exc.output.strip() != expected:
-                raise Exception('killall status: {} ({})'
-                                .format(exc.returncode, exc.output.strip()))
-        return time.time() - start
-
-    def push_files(self, machine, submission, testable):
+            load, cores = output.split()[-2:]
+            return float(load) / int(cores)
+        except ValueError:
+            return None
+
+    def outputs_equivalent(self, test_case, output_file):
+        """Return whether the output matches under the test case's comparison.
+
+        Both files are streamed thus no diff is needed to decide.
+
+        """
+        with open(File.file_path(self.base_file_path,
+                                 test_case.expected.sha1)) as expected:
+            if not os.path.isfile(output_file):
+                return outputs_equivalent(expected, [], test_case.comparison)
+            with open(output_file) as given:
+                return outputs_equivalent(expected, given,
+                                          test_case.comparison)
+
+    def push_files(self, machine, submission, testables, work_dir):
+        """Send the job specification and any blobs the worker lacks.
+
+        Every file is identified by its sha1. The blobs are synchronized into
+        the worker's `cache/` directory, skipping those already present, and
+        the worker hard links them into place according to the `files`
+        manifest of each testable in data.json. The worker verifies each
+        blob when it arrives and removes any found corrupt.
+
+        """
+        specs = [self.testable_spec(submission, x) for x in testables]
+
+        # Symlink each distinct blob by its sha1
+        blobs_dir = tempfile.mkdtemp(dir=work_dir)
+        for sha1 in set(y for x in specs for y in x['files'].values()):
+            os.symlink(File.file_path(self.base_file_path, sha1),
+                       os.path.join(blobs_dir, sha1))
+
+        # Generate data dictionary
+        data = {'key': job_key(submission.id, [x.id for x in testables]),
+                'test_concurrency': self.test_concurrency,
+                'testables': specs}
+
+        # Save data specification
+        spec_dir = os.path.join(work_dir, 'working')
+        os.mkdir(spec_dir)
+        with open(os.path.join(spec_dir, 'data.json'), 'w') as fp:
+            json.dump(data, fp)
+
+        # Rsync the missing blobs and then the specification
+        self.rsync(machine, blobs_dir, remote='cache/', from_local=True,
+                   options='--ignore-existing --chmod=Fu=r,go=')
+        self.rsync(machine, spec_dir, from_local=True)
+
+    @staticmethod
+    def testable_spec(submission, testable):
+        """Return the worker's specification for a single testable.
+
+        Paths in `files` are relative to the testable's own directory.
+
+        """
         submitted = {x.filename: x.file.sha1 for x in submission.files}
         build_files = {x.filename: x.file.sha1 for x in testable.build_files}
+        files = {}  # Maps the path on the worker to the file's sha1
 
-        # Prepare build directory by symlinking the relevant submission files
-        os.mkdir('src')
+        # Prepare build directory with the relevant submission files
         for filev in testable.file_verifiers:
             if filev.filename in submitted:
-                source = File.file_path(self.base_file_path,
-                                        submitted[filev.filename])
-                os.symlink(source, os.path.join('src', filev.filename))
+                files[os.path.join('src', filev.filename)] = \
+                    submitted[filev.filename]
                 if filev.filename in build_files:
                     del build_files[filev.filename]
             elif not filev.optional:
                 raise HandledError('File verifier not satisfied: {0}'
                                    .format(filev.filename))
-        for name, sha1 in build_files.items():  # Symlink remaining build files
-            source = File.file_path(self.base_file_path, sha1)
-            os.symlink(source, os.path.join('src', name))
+        for name, sha1 in build_files.items():  # Add remaining build files
+            files[os.path.join('src', name)] = sha1
 
-        # Symlink Makefile to current directory if necessary
+        # Add Makefile to the working directory if necessary
         if submission.project.makefile and testable.make_target:
-            source = File.file_path(self.base_file_path,
-                                    submission.project.makefile.sha1)
-            os.symlink(source, 'Makefile')
+            files['Makefile'] = submission.project.makefile.sha1
 
-        # Symlink test inputs and copy build test case specifications
-        os.mkdir('inputs')
+        # Add test inputs and copy build test case specifications
         test_cases = []
         for test_case in testable.test_cases:
             test_cases.append(test_case.serialize())
             if test_case.stdin:
-                destination = os.path.join('inputs', test_case.stdin.sha1)
-                if not os.path.isfile(destination):
-                    source = File.file_path(self.base_file_path,
-                                            test_case.stdin.sha1)
-                    os.symlink(source, destination)
-
-        # Copy execution files
-        os.mkdir('execution_files')
+                files[os.path.join('inputs', test_case.stdin.sha1)] = \
+                    test_case.stdin.sha1
+
+        # Add execution files
         for execution_file in testable.execution_files:
-            destination = os.path.join('execution_files',
-                                       execution_file.filename)
-            source = File.file_path(self.base_file_path,
-                                    execution_file.file.sha1)
-            os.symlink(source, destination)
-        # Symlink sumbitted files that should be in the execution environment
+            files[os.path.join('execution_files', execution_file.filename)] \
+                = execution_file.file.sha1
+        # Add sumbitted files that should be in the execution environment
         for filev in testable.file_verifiers:
             if filev.copy_to_execution and filev.filename in submitted:
-                destination = os.path.join('execution_files', filev.filename)
-                source = File.file_path(self.base_file_path,
-                                        submitted[filev.filename])
-                os.symlink(source, destination)
+                files[os.path.join('execution_files', filev.filename)] = \
+                    submitted[filev.filename]
 
-        # Generate data dictionary
-        data = {'executable': testable.executable,
-                'key': '{}.{}'.format(submission.id, testable.id),
+        return {'executable': testable.executable,
+                'files': files,
+                'id': testable.id,
                 'make_target': testable.make_target,
                 'test_cases': test_cases}
 
-        # Save data specification
-        with open('data.json', 'w') as fp:
-            json.dump(data, fp)
-
-        # Rsync files
-        self.rsync(machine, from_local=True)
-
-    def rsync(self, machine, from_local=False):
-        src = '{}@{}:working/'.format(self.account, machine)
-        dst = '.'
-        if from_local:
-            src, dst = dst, src
-        cmd = ('rsync -e \'ssh -i {}\' --timeout=16 --delete -rLpv {} {}'
-               .format(self.private_key_file, src, dst))
+    def rsync(self, machine, local, remote='working/', from_local=False,
+              options='--delete'):
+        remote = '{}@{}:{}'.format(self.account, machine, remote)
+        local = os.path.join(local, '')
+        src, dst = (local, remote) if from_local else (remote, local)
+        cmd = ('rsync -e \'ssh {}\' --timeout=16 {} -rLpv {} {}'
+               .format(self.ssh_options(), options, src, dst))
         subprocess.check_call(cmd, stdout=open(os.devnull, 'w'), shell=True)
 
-    def ssh(self, machine, command, timeout=None):
-        options = '-o ConnectTimeout={}'.format(timeout) if timeout else ''
-        cmd = 'ssh -i {key} {options} {user}@{host} {command}'.format(
-            key=self.private_key_file, user=self.account, host=machine,
-            command=command, options=options)
-        proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
+    def ssh(self, machine, command='', timeout=None, options=''):
+        """Run command on machine through the control master.
+
+        Output is collected through temporary files rather than pipes as the
+        backgrounded control master inherits, and holds open, both streams.
+
+        """
+        options = '{} {}'.format(self.ssh_options(), options)
+        if timeout:
+            options += ' -o ConnectTimeout={}'.format(timeout)
+        cmd = 'ssh {options} {user}@{host} {command}'.format(
+            user=self.account, host=machine, command=command,
+            options=options)
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            returncode = subprocess.call(cmd, shell=True, stderr=err,
+                                         stdout=out)
+            out.seek(0)
+            err.seek(0)
+            stdout, stderr = out.read(), err.read()
+        if returncode != 0:
             if stderr.strip().endswith('Connection timed out'):
                 raise SSHConnectTimeout()
             output = stdout + '\n' + stderr if stdout else stderr
-            raise subprocess.CalledProcessError(proc.returncode, cmd,
+            raise subprocess.CalledProcessError(returncode, cmd,
                                                 output=output)
+        return stdout
+
+    def ssh_options(self):
+        return '-i {} -o ControlPath={}'.format(self.private_key_file,
+                                                self.control_path)
 
 
 def main():
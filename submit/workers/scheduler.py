@@ -0,0 +1,141 @@
+import json
+import os
+import random
+import threading
+import time
+
+
+class MachineStats(object):
+
+    """Track the recent behavior of a single worker machine.
+
+    `job_time` and `failure_rate` are exponentially weighted moving averages
+    of the end-to-end job time (in seconds) and of whether each job failed.
+    `penalty` (also in seconds) decays by half every `half_life` seconds.
+
+    """
+
+    def __init__(self, name, weight=1.):
+        self.name = name
+        self.weight = weight
+        self.busy = False
+        self.failure_rate = 0.
+        self.job_time = None
+        self.load = 0.
+        self.penalty = 0.
+        self.penalty_time = time.time()
+
+    def current_penalty(self, half_life, now=None):
+        elapsed = (now or time.time()) - self.penalty_time
+        return self.penalty * 0.5 ** (elapsed / half_life)
+
+    def score(self, default_time, half_life, failure_cost, now=None):
+        """Return the weighted expected cost of running a job (lower is better).
+
+        The expected job time is inflated by the per-core load reported when
+        the machine was last used, and by its failure rate since a failure
+        means running the job again elsewhere.
+
+        """
+        job_time = default_time if self.job_time is None else self.job_time
+        expected = (job_time * (1 + self.load) *
+                    (1 + failure_cost * self.failure_rate))
+        return (expected + self.current_penalty(half_life, now)) / self.weight
+
+
+class MachineScheduler(object):
+
+    """Hand out idle machines in order of their score.
+
+    Each machine runs at most one job at a time. Machines are given as
+    `host` or `host:weight`, where a machine of weight 2 is preferred as
+    though it were twice as fast.
+
+    """
+
+    def __init__(self, machines, alpha=0.3, default_time=5., failure_cost=4.,
+                 half_life=600., scoreboard_file=None):
+        self.alpha = alpha
+        self.default_time = default_time
+        self.failure_cost = failure_cost
+        self.half_life = half_life
+        self.scoreboard_file = scoreboard_file
+        self.cv = threading.Condition()
+        self.machines = []
+        for machine in machines:
+            name, _, weight = machine.partition(':')
+            self.machines.append(MachineStats(name, float(weight or 1)))
+        random.shuffle(self.machines)  # Break initial ties randomly
+
+    def acquire(self):
+        """Return the name of the best idle machine.
+
+        Block until a machine is released by another thread if none are idle.
+
+        """
+        with self.cv:
+            while True:
+                now = time.time()
+                idle = [x for x in self.machines if not x.busy]
+                if idle:
+                    break
+                self.cv.wait()
+            best = min(idle, key=lambda x: x.score(
+                self.default_time, self.half_life, self.failure_cost, now))
+            best.busy = True
+            return best.name
+
+    def release(self, name, job_time=None, failed=False, penalty=0.,
+                load=None):
+        """Record the outcome of a job on machine `name` and free it.
+
+        `job_time` is only given for successful jobs. Return the machine's
+        scoreboard entry.
+
+        """
+        with self.cv:
+            stats = next(x for x in self.machines if x.name == name)
+            now = time.time()
+            if job_time is not None:
+                stats.job_time = job_time if stats.job_time is None else \
+                    self.alpha * job_time + (1 - self.alpha) * stats.job_time
+            if failed is not None:
+                stats.failure_rate = (self.alpha * float(failed) +
+                                      (1 - self.alpha) * stats.failure_rate)
+            if load is not None:
+                stats.load = load
+            stats.penalty = stats.current_penalty(self.half_life, now) + \
+                penalty
+            stats.penalty_time = now
+            stats.busy = False
+            self.cv.notify()
+            scoreboard = self.scoreboard(now)
+        if self.scoreboard_file:
+            self.save_scoreboard(scoreboard)
+        return next(x for x in scoreboard if x['machine'] == name)
+
+    def save_scoreboard(self, scoreboard):
+        tmp_file = '{}.tmp{}'.format(self.scoreboard_file,
+                                     threading.current_thread().ident)
+        with open(tmp_file, 'w') as fp:
+            json.dump(scoreboard, fp, indent=2, sort_keys=True)
+        os.rename(tmp_file, self.scoreboard_file)
+
+    def scoreboard(self, now=None):
+        """Return the state of every machine, best scoring first."""
+        now = now or time.time()
+        with self.cv:
+            board = [{'busy': x.busy,
+                      'failure_rate': round(x.failure_rate, 3),
+                      'job_time': (None if x.job_time is None
+                                   else round(x.job_time, 3)),
+                      'load': round(x.load, 3),
+                      'machine': x.name,
+                      'penalty': round(x.current_penalty(self.half_life,
+                                                         now), 3),
+                      'score': round(x.score(self.default_time,
+                                             self.half_life,
+                                             self.failure_cost, now), 3),
+                      'weight': x.weight}
+                     for x in self.machines]
+        return sorted(board, key=lambda x: x['score'])
@@ -43,9 +43,9 @@ def do_work(submission_id, update_project=False):
             break
     if valid_testables:
         workers.log_msg('Passed: {0}'.format(submission_id))
-        retval = [{'submission_id': submission_id, 'testable_id': x.id,
-                   'update_project': update_project}
-                  for x in valid_testables]
+        retval = [{'submission_id': submission_id,
+                   'testable_ids': [x.id for x in valid_testables],
+                   'update_project': update_project}]
     else:
         workers.log_msg('Failed: {0}'.format(submission_id))
         if update_project:
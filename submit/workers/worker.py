@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 import errno
+import hashlib
 import json
+import multiprocessing
 import os
+import resource
 import shlex
 import shutil
 import select
@@ -19,10 +22,21 @@ SRC_PATH = 'src'
 INPUT_PATH = 'inputs'
 RESULTS_PATH = 'results'
 EXECUTION_FILES_PATH = 'execution_files'
-
+CACHE_PATH = os.path.join('..', 'cache')
+# Maps the sha1 of each verified blob to the stat it was verified with
+CACHE_INDEX_PATH = os.path.join('..', 'cache.json')
+BUILD_CACHE_PATH = os.path.join('..', 'builds')
+
+CAPTURE_BUFFER_SIZE = 1048576
+CORRUPT_BLOB_STATUS = 3
+MAX_BUILD_CACHE_SIZE = 268435456
+MAX_CACHE_SIZE = 536870912
 MAX_FILE_SIZE = 81920
 TIME_LIMIT = 4
 
+# The sandbox of each process, keyed by the directory holding it
+SANDBOXES = {}
+
 # Prepare Child Environemtn to disable CCACHE
 CHILD_ENV = os.environ.copy()
 CHILD_ENV.update(CCACHE_DISABLE='1')
@@ -43,17 +57,40 @@ def alarm_handler(_, _a):
 class Worker(object):
     @staticmethod
     def execute(command, stderr=None, stdin=None, stdout=None, files=None,
-                save=None):
-        if not stderr:
-            stderr = open('/dev/null', 'w')
-        if not stdout:
-            stdout = open('/dev/null', 'w')
-
-        # Create temporary directory and copy execution files
-        tmp_dir = tempfile.mkdtemp()
-        for filename in os.listdir(EXECUTION_FILES_PATH):
-            shutil.copy(os.path.join(EXECUTION_FILES_PATH, filename),
-                        os.path.join(tmp_dir, filename))
+                save=None, limit=None, sandbox=None, timing=None,
+                file_limit=None):
+        """Run command and return its exit status.
+
+        At most one of `stdout` and `stderr` may be given. That stream is
+        captured into the given file while the process runs; once more than
+        `limit` bytes are produced the file is left holding exactly `limit`
+        bytes, the process group is killed and OutputLimitExceeded is raised.
+
+        With `file_limit` no file written by the command can grow past that
+        many bytes. A command killed for trying raises OutputLimitExceeded.
+
+        The command runs in `sandbox`, which is reset beforehand, or in a
+        fresh one when None. The seconds spent preparing the sandbox and
+        running the command are stored in `timing` when given.
+
+        """
+        start = time.time()
+        devnull = open(os.devnull, 'w')
+        output = stdout or stderr
+        if stdout:
+            stdout, stderr = PIPE, devnull
+        elif stderr:
+            stdout, stderr = devnull, PIPE
+        else:
+            stdout = stderr = devnull
+
+        # Prepare the directory holding the execution files
+        if sandbox:
+            sandbox.reset()
+            tmp_sandbox = None
+        else:
+            sandbox = tmp_sandbox = Sandbox(EXECUTION_FILES_PATH)
+        tmp_dir = sandbox.path
 
         args = shlex.split(command)
         # allow some programs
@@ -78,37 +115,51 @@ class Worker(object):
         elif len(args) > 2 and args[1] == 'turtle_capture.sh':
             time_limit *= 4  # How can we run this faster?
 
+        def preexec():
+            os.setsid()
+            if file_limit is not None:
+                resource.setrlimit(resource.RLIMIT_FSIZE,
+                                   (file_limit, file_limit))
+
         # Run command with a timelimit
-        # TODO: Do we only get partial output with stdout?
+        if timing is not None:
+            timing['setup'] = time.time() - start
+        start = time.time()
+        deadline = start + time_limit
         try:
-            poll = select.epoll()
-            main_pipe = Popen(args, stdin=stdin, stdout=PIPE, stderr=stderr,
-                              cwd=tmp_dir, preexec_fn=os.setsid,
+            main_pipe = Popen(args, stdin=stdin, stdout=stdout, stderr=stderr,
+                              cwd=tmp_dir, preexec_fn=preexec,
                               executable=executable, env=CHILD_ENV)
-            poll.register(main_pipe.stdout, select.EPOLLIN | select.EPOLLHUP)
-            do_poll = True
-            start = time.time()
-            while do_poll:
-                remaining_time = start + time_limit - time.time()
-                if remaining_time <= 0:
-                    if main_pipe.poll() is None:  # Ensure it's still running
-                        # Kill the entire process group
+            if output:
+                pipe = main_pipe.stdout or main_pipe.stderr
+                try:
+                    Worker.capture(pipe.fileno(), output.fileno(), deadline,
+                                   limit)
+                except (OutputLimitExceeded, TimeoutException):
+                    # Kill the entire process group
+                    try:
                         os.killpg(main_pipe.pid, signal.SIGKILL)
-                        raise TimeoutException()
-                for file_descriptor, event in poll.poll(remaining_time):
-                    stdout.write(os.read(file_descriptor, 8192))
-                    if event == select.POLLHUP:
-                        poll.unregister(file_descriptor)
-                        do_poll = False
-
+                    except OSError as exc:
+                        if exc.errno != errno.ESRCH:
+                            raise
+                    main_pipe.wait()
+                    raise
+                finally:
+                    pipe.close()
+
+            # Only the time left until the deadline, as capturing used the rest
             signal.signal(signal.SIGALRM, alarm_handler)
-            signal.alarm(time_limit)
+            signal.setitimer(signal.ITIMER_REAL,
+                             max(deadline - time.time(), 0.001))
             try:
                 main_status = main_pipe.wait()
-                signal.alarm(0)
+                signal.setitimer(signal.ITIMER_REAL, 0)
             except TimeoutAlarm:
                 os.killpg(main_pipe.pid, signal.SIGKILL)
+                main_pipe.wait()
                 raise TimeoutException()
+            if file_limit is not None and main_status == -signal.SIGXFSZ:
+                raise OutputLimitExceeded(file_limit)
             if main_status < 0:
                 raise SignalException(-1 * main_status)
             return main_status
@@ -122,23 +173,167 @@ class Worker(object):
                 src = os.path.join(tmp_dir, save[0])
                 if os.path.isfile(src):
                     shutil.copy(src, save[1])
-            shutil.rmtree(tmp_dir)
+            if timing is not None:
+                timing['run'] = time.time() - start
+            if tmp_sandbox:
+                tmp_sandbox.cleanup()
+            devnull.close()
+
+    @staticmethod
+    def capture(src_fd, dst_fd, deadline, limit=None):
+        """Copy from src_fd to dst_fd until EOF, the deadline or the limit.
+
+        Writes never exceed `limit` bytes in total. Reading stops as soon as
+        a byte past the limit arrives rather than draining the process.
+
+        The data passes through a buffer rather than splice(2), which Python
+        2 does not expose, as each chunk is counted against the limit anyway
+        and is at most MAX_FILE_SIZE bytes in total.
+
+        """
+        poll = select.epoll()
+        poll.register(src_fd, select.EPOLLIN | select.EPOLLHUP)
+        written = 0
+        try:
+            while True:
+                remaining_time = deadline - time.time()
+                if remaining_time <= 0:
+                    raise TimeoutException()
+                if not poll.poll(remaining_time):
+                    continue
+                data = os.read(src_fd, CAPTURE_BUFFER_SIZE)
+                if not data:  # EOF
+                    return written
+                if limit is not None and written + len(data) > limit:
+                    data = data[:limit - written]
+                    while data:
+                        data = data[os.write(dst_fd, data):]
+                    raise OutputLimitExceeded(limit)
+                written += len(data)
+                while data:
+                    data = data[os.write(dst_fd, data):]
+        finally:
+            poll.close()
 
     def __init__(self):
         # Load testable information
+        self.build_hits = self.build_misses = 0
+        self.build_keys = set()
+        self.results_path = None
         os.chdir('working')
         with open('data.json') as fp:
             self.data = json.load(fp)
 
+    @staticmethod
+    def evict_blobs(keep):
+        """Remove least recently used blobs until the cache fits its limit.
+
+        Blobs whose sha1 is in `keep` are never removed.
+
+        """
+        blobs = []
+        total = 0
+        for sha1 in os.listdir(CACHE_PATH):
+            path = os.path.join(CACHE_PATH, sha1)
+            stat = os.stat(path)
+            total += stat.st_size
+            if sha1 not in keep:
+                blobs.append((stat.st_atime, stat.st_size, path))
+        blobs.sort(reverse=True)
+        while total > MAX_CACHE_SIZE and blobs:
+            _, size, path = blobs.pop()
+            os.unlink(path)
+            total -= size
+
+    @staticmethod
+    def link_files(files):
+        """Hard link the testable's files into place from the blob cache."""
+        for path in (SRC_PATH, INPUT_PATH, EXECUTION_FILES_PATH):
+            os.mkdir(path)
+        for path, sha1 in files.items():
+            # The testable's directory is one level below CACHE_PATH's base
+            source = os.path.join('..', CACHE_PATH, sha1)
+            try:
+                os.link(source, path)
+            except OSError as exc:
+                if exc.errno != errno.EXDEV:
+                    raise
+                shutil.copyfile(source, path)
+            # Mark the blob as recently used, leaving its mtime unchanged
+            os.utime(source, (time.time(), os.stat(source).st_mtime))
+
+    @staticmethod
+    def verify_blobs(blobs):
+        """Verify each blob against its sha1 when first used.
+
+        The stat of each verified blob is kept in CACHE_INDEX_PATH thus a
+        blob is only read again once its inode, size, mode or mtime change,
+        as they do when rsync delivers it or a job modifies it. Blobs that do
+        not match are removed from the cache and CorruptBlob is raised.
+
+        """
+        try:
+            with open(CACHE_INDEX_PATH) as fp:
+                index = json.load(fp)
+        except (IOError, ValueError):
+            index = {}
+        corrupt = []
+        for sha1 in blobs:
+            path = os.path.join(CACHE_PATH, sha1)
+            stat = os.stat(path)
+            signature = [stat.st_ino, stat.st_size, stat.st_mode,
+                         stat.st_mtime]
+            if index.get(sha1) == signature:
+                continue
+            digest = hashlib.sha1()
+            with open(path, 'rb') as fp:
+                for data in iter(lambda: fp.read(65536), b''):
+                    digest.update(data)
+            if digest.hexdigest() == sha1:
+                index[sha1] = signature
+            else:
+                index.pop(sha1, None)
+                os.unlink(path)
+                corrupt.append(sha1)
+        with open(CACHE_INDEX_PATH, 'w') as fp:
+            json.dump({x: y for x, y in index.items()
+                       if os.path.isfile(os.path.join(CACHE_PATH, x))}, fp)
+        if corrupt:
+            raise CorruptBlob(corrupt)
+
     def run(self):
+        """Build and run each testable in its own directory.
+
+        Results for each testable are saved to `results/<testable_id>/`.
+
+        """
+        if not os.path.isdir(BUILD_CACHE_PATH):
+            os.mkdir(BUILD_CACHE_PATH)
+        builds = {}
+        blobs = set(y for x in self.data['testables']
+                    for y in x['files'].values())
+        self.verify_blobs(blobs)
+        for testable in self.data['testables']:
+            os.makedirs(os.path.join(RESULTS_PATH, str(testable['id'])))
+            self.results_path = os.path.join('..', RESULTS_PATH,
+                                             str(testable['id']))
+            os.mkdir(str(testable['id']))
+            os.chdir(str(testable['id']))
+            try:
+                self.link_files(testable['files'])
+                self.run_testable(testable, builds)
+            finally:
+                os.chdir('..')
+        self.evict_blobs(blobs)
+        self.evict_builds(self.build_keys)
+
+    def run_testable(self, testable, builds):
         # Build and run tests
-        os.mkdir(RESULTS_PATH)
         result = {}
         try:
-            if self.data['make_target']:
-                result['make'] = self.make_project(self.data['executable'],
-                                                   self.data['make_target'])
-            self.run_tests(self.data['test_cases'])
+            if testable['make_target']:
+                result['make'] = self.make_project(testable, builds)
+            self.run_tests(testable['test_cases'])
             result['status'] = 'success'
         except (MakeFailed, NonexistentExecutable) as exc:
             # Truncate and replace invalid ascii characters
@@ -147,78 +342,282 @@ class Worker(object):
             result['status'] = 'make_failed' if isinstance(exc, MakeFailed) \
                 else 'nonexistent_executable'
         # Save results
-        with open(os.path.join(RESULTS_PATH, 'testable'), 'w') as fp:
+        with open(os.path.join(self.results_path, 'testable'), 'w') as fp:
             json.dump(result, fp)
 
-    def make_project(self, executable, target):
-        """Build the project and verify the executable exists."""
-        command = 'make -f ../Makefile -C {0} {1}'.format(SRC_PATH, target)
-        pipe = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT,
-                     env=CHILD_ENV)
-        output = pipe.communicate()[0]
-        if pipe.returncode != 0:
+    def make_project(self, testable, builds):
+        """Build the project and verify the executable exists.
+
+        Testables with identical sources, Makefile and target share a single
+        build: `builds` maps those to the directory and outcome of the first
+        testable built with them. Successful builds are also kept in the
+        build cache so later jobs with the same inputs skip make entirely.
+
+        """
+        manifest = sorted(x for x in testable['files'].items()
+                          if x[0] == 'Makefile' or
+                          x[0].startswith(SRC_PATH + os.sep))
+        key = hashlib.sha1(json.dumps([testable['make_target'], manifest])) \
+            .hexdigest()
+        self.build_keys.add(key)
+        if key in builds:
+            build_dir, returncode, output = builds[key]
+            shutil.rmtree(SRC_PATH)
+            shutil.copytree(os.path.join('..', build_dir, SRC_PATH), SRC_PATH)
+        else:
+            # The testable's directory is one level below the cache's base
+            entry = os.path.join('..', BUILD_CACHE_PATH, key)
+            output = self.restore_build(entry)
+            if output is not None:
+                self.build_hits += 1
+                returncode = 0
+            else:
+                self.build_misses += 1
+                command = 'make -f ../Makefile -C {0} {1}'.format(
+                    SRC_PATH, testable['make_target'])
+                pipe = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT,
+                             env=CHILD_ENV)
+                output = pipe.communicate()[0]
+                returncode = pipe.returncode
+                if returncode == 0 and os.path.isfile(
+                        os.path.join(SRC_PATH, testable['executable'])):
+                    self.store_build(entry, output)
+            builds[key] = str(testable['id']), returncode, output
+        if returncode != 0:
             raise MakeFailed(output)
-        if not os.path.isfile(os.path.join(SRC_PATH, executable)):
+        if not os.path.isfile(os.path.join(SRC_PATH, testable['executable'])):
             raise NonexistentExecutable(output)
         return output
 
+    @staticmethod
+    def restore_build(entry):
+        """Replace the build directory with a cached build.
+
+        Return the cached make output, or None when there is no such build.
+
+        """
+        output_file = os.path.join(entry, 'output')
+        if not os.path.isfile(output_file):
+            return None
+        shutil.rmtree(SRC_PATH)
+        shutil.copytree(os.path.join(entry, SRC_PATH), SRC_PATH,
+                        symlinks=True)
+        os.utime(output_file, None)  # Mark the build as recently used
+        with open(output_file) as fp:
+            return fp.read()
+
+    @staticmethod
+    def store_build(entry, output):
+        """Save the build directory and make output into the build cache."""
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        try:
+            shutil.copytree(SRC_PATH, os.path.join(tmp_dir, SRC_PATH),
+                            symlinks=True)
+            size = 0
+            for path, _, filenames in os.walk(tmp_dir):
+                for filename in filenames:
+                    size += os.lstat(os.path.join(path, filename)).st_size
+            with open(os.path.join(tmp_dir, 'size'), 'w') as fp:
+                fp.write(str(size + len(output)))
+            # Write output last as its presence marks a complete build
+            with open(os.path.join(tmp_dir, 'output'), 'w') as fp:
+                fp.write(output)
+            os.rename(tmp_dir, entry)
+        except (IOError, OSError):  # The cache is only an optimization
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def evict_builds(keep):
+        """Remove least recently used builds until the cache fits its limit.
+
+        Builds whose key is in `keep` are never removed.
+
+        """
+        builds = []
+        total = 0
+        for key in os.listdir(BUILD_CACHE_PATH):
+            path = os.path.join(BUILD_CACHE_PATH, key)
+            try:
+                with open(os.path.join(path, 'size')) as fp:
+                    size = int(fp.read())
+                mtime = os.stat(os.path.join(path, 'output')).st_mtime
+            except (IOError, OSError, ValueError):  # Incomplete entry
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            total += size
+            if key not in keep:
+                builds.append((mtime, size, path))
+        builds.sort(reverse=True)
+        while total > MAX_BUILD_CACHE_SIZE and builds:
+            _, size, path = builds.pop()
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
     def run_tests(self, test_cases):
+        """Run the test cases and save their results.
+
+        Test cases are independent, each running in its own temporary
+        directory and process group, thus up to `test_concurrency` (default:
+        the number of cores) of them are run at once in separate processes.
+
+        """
+        concurrency = min(self.data.get('test_concurrency') or
+                          multiprocessing.cpu_count(), len(test_cases))
+        sandbox_root = tempfile.mkdtemp()
+        jobs = [(tc, self.results_path, sandbox_root) for tc in test_cases]
+        try:
+            if concurrency > 1:
+                pool = multiprocessing.Pool(concurrency)
+                try:
+                    results = dict(pool.map(run_test_case, jobs))
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                results = dict(run_test_case(x) for x in jobs)
+        finally:
+            SANDBOXES.pop(sandbox_root, None)
+            shutil.rmtree(sandbox_root, ignore_errors=True)
+        with open(os.path.join(self.results_path, 'test_cases'), 'w') as fp:
+            json.dump(results, fp)
+
+    @staticmethod
+    def run_test_case(tc, results_path, sandbox_root):
+        """Run a single test case and return its result.
+
+        Each process reuses one sandbox below `sandbox_root` for all the
+        test cases it runs.
+
+        """
         def execute(*args, **kwargs):
             try:
-                result['extra'] = self.execute(*args, **kwargs)
+                result['extra'] = Worker.execute(
+                    *args, sandbox=sandbox, timing=result['timing'], **kwargs)
                 result['status'] = 'success'
             except NonexistentExecutable:
                 result['status'] = 'nonexistent_executable'
             except SignalException as exc:
                 result['extra'] = exc.signum
                 result['status'] = 'signal'
+            except OutputLimitExceeded as exc:
+                print('\ttruncated outputfile at', exc.size)
+                result['status'] = 'output_limit_exceeded'
             except TimeoutException:
                 result['status'] = 'timed_out'
 
-        results = {}
-        for tc in test_cases:
-            output_file = os.path.join(RESULTS_PATH, 'tc_{0}'.format(tc['id']))
-            if tc['stdin']:
-                stdin_file = os.path.join(INPUT_PATH, tc['stdin'])
-                stdin = open(stdin_file)
-            else:
-                stdin = None
-            result = {'extra': None}
-
-            max_file_size = MAX_FILE_SIZE
-            # Mange output file
-            if tc['source'] != 'file':
-                with open(output_file, 'wb') as output:
-                    if tc['source'] == 'stdout':
-                        stdout = output
-                        stderr = None
-                    else:
-                        stdout = None
-                        stderr = output
-                    execute(tc['args'], stderr=stderr, stdin=stdin,
-                            stdout=stdout)
-            else:
-                execute(tc['args'], save=(tc['output_filename'], output_file))
-                if tc['output_filename'].endswith('.png'):
-                    max_file_size = 131072  # Avoid truncating images
-
-            if not os.path.isfile(output_file):
-                # Hack on this status until we update the ENUM
-                if result['status'] == 'success':
-                    # Don't overwrite other statuses
-                    result['status'] = 'output_limit_exceeded'
-            elif os.path.getsize(output_file) > max_file_size:
-                # Truncate output file size
-                print('\ttruncating outputfile', os.path.getsize(output_file))
-                fd = os.open(output_file, os.O_WRONLY)
-                os.ftruncate(fd, max_file_size)
-                os.close(fd)
-                if result['status'] == 'success':
-                    # Don't overwrite other statuses
-                    result['status'] = 'output_limit_exceeded'
-            results[tc['id']] = result
-        with open(os.path.join(RESULTS_PATH, 'test_cases'), 'w') as fp:
-            json.dump(results, fp)
+        if sandbox_root not in SANDBOXES:
+            SANDBOXES[sandbox_root] = Sandbox(EXECUTION_FILES_PATH,
+                                              dir=sandbox_root)
+        sandbox = SANDBOXES[sandbox_root]
+
+        output_file = os.path.join(results_path, 'tc_{0}'.format(tc['id']))
+        if tc['stdin']:
+            stdin_file = os.path.join(INPUT_PATH, tc['stdin'])
+            stdin = open(stdin_file)
+        else:
+            stdin = None
+        result = {'extra': None, 'timing': {}}
+
+        max_file_size = MAX_FILE_SIZE
+        # Mange output file
+        if tc['source'] != 'file':
+            with open(output_file, 'wb') as output:
+                if tc['source'] == 'stdout':
+                    stdout = output
+                    stderr = None
+                else:
+                    stdout = None
+                    stderr = output
+                execute(tc['args'], stderr=stderr, stdin=stdin,
+                        stdout=stdout, limit=max_file_size)
+        else:
+            if tc['output_filename'].endswith('.png'):
+                max_file_size = 131072  # Avoid truncating images
+            # One byte more than kept so the saved file shows it was exceeded
+            execute(tc['args'], save=(tc['output_filename'], output_file),
+                    file_limit=max_file_size + 1)
+
+        if not os.path.isfile(output_file):
+            # Hack on this status until we update the ENUM
+            if result['status'] == 'success':
+                # Don't overwrite other statuses
+                result['status'] = 'output_limit_exceeded'
+        elif os.path.getsize(output_file) > max_file_size:
+            # Truncate saved output files (streams are limited while captured)
+            print('\ttruncating outputfile', os.path.getsize(output_file))
+            fd = os.open(output_file, os.O_WRONLY)
+            os.ftruncate(fd, max_file_size)
+            os.close(fd)
+            if result['status'] == 'success':
+                # Don't overwrite other statuses
+                result['status'] = 'output_limit_exceeded'
+        return tc['id'], result
+
+
+def run_test_case(args):
+    """Pool entry point: bound methods cannot be pickled."""
+    return Worker.run_test_case(*args)
+
+
+class Sandbox(object):
+    """A directory holding copies of the execution files.
+
+    The files are copied once. Between runs, `reset` removes anything a run
+    created and copies back only the files it modified or removed.
+
+    """
+    def __init__(self, source, dir=None):
+        self.path = tempfile.mkdtemp(dir=dir)
+        self.files = {}  # Maps each name to the stat of its pristine copy
+        for filename in os.listdir(source):
+            self.add(os.path.join(source, filename), filename)
+
+    @staticmethod
+    def _signature(path):
+        # ctime changes on any write and cannot be set by the program
+        stat = os.lstat(path)
+        return stat.st_ino, stat.st_size, stat.st_mtime, stat.st_ctime
+
+    def add(self, src, name):
+        """Copy src into the sandbox as name unless already present."""
+        path = os.path.join(self.path, name)
+        if name in self.files and os.path.lexists(path) \
+                and self._signature(path) == self.files[name][1]:
+            return
+        shutil.copyfile(src, path)
+        self.files[name] = src, self._signature(path)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def reset(self):
+        """Restore the sandbox to only its pristine files."""
+        try:
+            os.chmod(self.path, 0o700)
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                if name in self.files \
+                        and self._signature(path) == self.files[name][1]:
+                    continue
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            for name, (src, _) in self.files.items():
+                self.add(src, name)
+        except (IOError, OSError):  # Start over with a fresh directory
+            parent = os.path.dirname(self.path)
+            self.cleanup()
+            self.path = tempfile.mkdtemp(dir=parent)
+            for name, (src, _) in self.files.items():
+                del self.files[name]
+                self.add(src, name)
+
+
+class CorruptBlob(Exception):
+    """Indicate that cached blobs no longer match their sha1."""
+    def __init__(self, sha1s):
+        self.sha1s = sha1s
 
 
 class MakeFailed(Exception):
@@ -229,6 +628,12 @@ class NonexistentExecutable(Exception):
     """Indicate that the expected binary does not exist."""
 
 
+class OutputLimitExceeded(Exception):
+    """Indicate that a process produced more output than allowed."""
+    def __init__(self, size):
+        self.size = size
+
+
 class SignalException(Exception):
     """Indicate that a process was terminated via a signal"""
     def __init__(self, signum):
@@ -248,14 +653,19 @@ def main():
             wp.run()
             status = 'success'
             return 0
+        except CorruptBlob as exc:  # The proxy sends the blobs again
+            status = 'corrupt blobs {}'.format(' '.join(exc.sha1s))
+            return CORRUPT_BLOB_STATUS
         except Exception:
             traceback.print_exc(file=fp)
             raise
         finally:
-            fp.write('{date} {key} {machine} {status} in {delta} seconds\n'
+            fp.write('{date} {key} {machine} {status} in {delta} seconds '
+                     '(builds: {hits} hit {misses} miss)\n'
                      .format(date=datetime.now(), key=wp.data['key'],
                              machine=socket.gethostname(),
-                             status=status, delta=time.time() - start))
+                             status=status, delta=time.time() - start,
+                             hits=wp.build_hits, misses=wp.build_misses))
 
 
 if __name__ == '__main__':